@@ -0,0 +1,50 @@
+"""Compares the json codecs and ETF on READY and GUILD_CREATE payloads of the fake gateway.
+
+    python benchmarks/codec.py [--guilds N] [--members N] [--rounds N]
+"""
+import argparse
+import time
+
+from payloads import gateway_frames
+from distee import etf, utils
+
+
+def _codecs():
+    codecs = {name: (c.loads, c.dumps) for name, c in utils._json_codecs.items()}
+    codecs['etf'] = (etf.decode, etf.encode)
+    return codecs
+
+
+def _per_second(func, items, rounds: int) -> float:
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for item in items:
+            func(item)
+    return rounds * len(items) / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--guilds', type=int, default=20)
+    parser.add_argument('--members', type=int, default=100, help='members per guild, above 250 only the bot is sent')
+    parser.add_argument('--rounds', type=int, default=20)
+    args = parser.parse_args()
+    frames = gateway_frames(args.guilds, args.members)
+    groups = {
+        'READY': [d for t, d in frames if t == 'READY'],
+        'GUILD_CREATE': [d for t, d in frames if t == 'GUILD_CREATE']
+    }
+    print(f'{"payload":<14}{"codec":<8}{"bytes":>10}{"decode/s":>12}{"encode/s":>12}')
+    for event, payloads in groups.items():
+        for name, (loads, dumps) in _codecs().items():
+            encoded = [dumps(p) for p in payloads]
+            size = sum(len(e) for e in encoded) // len(encoded)
+            # READY is a single tiny payload, repeat it so the timing means something
+            rounds = args.rounds * (100 if event == 'READY' else 1)
+            decode = _per_second(loads, encoded, rounds)
+            encode = _per_second(dumps, payloads, rounds)
+            print(f'{event:<14}{name:<8}{size:>10}{decode:>12.0f}{encode:>12.0f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,22 @@
+import os
+import sys
+from typing import List, Tuple
+
+# run as plain scripts from a checkout, the benchmarks are not part of the package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from distee.fake_gateway import FakeGateway  # noqa: E402
+
+
+def gateway_frames(guilds: int = 20, members_per_guild: int = 100, messages: int = 0) -> List[Tuple[str, dict]]:
+    """The dispatch payloads of a fresh session: READY, a GUILD_CREATE per guild and then messages
+    MESSAGE_CREATE events spread over the guilds"""
+    gateway = FakeGateway(guilds=guilds, members_per_guild=members_per_guild)
+    guild_ids = sorted(gateway.guilds)
+    frames = [('READY', {'op': 0, 't': 'READY', 's': 1, 'd': gateway.make_ready('benchmark')})]
+    for seq, gid in enumerate(guild_ids, start=2):
+        frames.append(('GUILD_CREATE', {'op': 0, 't': 'GUILD_CREATE', 's': seq, 'd': gateway.make_guild(gid)}))
+    for i in range(messages):
+        frames.append(('MESSAGE_CREATE', {'op': 0, 't': 'MESSAGE_CREATE', 's': len(frames) + 1,
+                                          'd': gateway.make_message(guild_ids[i % len(guild_ids)])}))
+    return frames
@@ -0,0 +1,104 @@
+"""Routes/s of precompiled route templates compared to the str.replace formatting they replaced.
+
+Every route is built and its url and bucket are read once, like HTTPClient.request does.
+
+    python benchmarks/routes.py [--count N] [--rounds N]
+"""
+import argparse
+import os
+import sys
+import time
+
+# run as plain scripts from a checkout, the benchmarks are not part of the package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from distee.route import Route, RouteTemplate  # noqa: E402
+from distee.utils import Snowflake, API_VERSION  # noqa: E402
+
+
+def _parameter_str(v) -> str:
+    return str(v.id) if isinstance(v, Snowflake) else str(v)
+
+
+class FormattedRoute:
+    """Route as it was before the templates, the url is built with one str.replace per parameter"""
+
+    BASE_URL = f'https://discord.com/api/v{API_VERSION}'
+    MAJOR_PARAMETERS = ('channel_id', 'guild_id', 'webhook_id', 'webhook_token', 'interaction_token')
+
+    def __init__(self, method: str, path: str, **parameters):
+        self.path = path
+        self.method = method
+        self.url = self.BASE_URL + self.path
+        if parameters:
+            for k, v in parameters.items():
+                self.url = self.url.replace('{'+k+'}', _parameter_str(v))
+        self.channel_id = parameters.get('channel_id')
+        if isinstance(self.channel_id, Snowflake):
+            self.channel_id = self.channel_id.id
+        self.guild_id = parameters.get('guild_id')
+        if isinstance(self.guild_id, Snowflake):
+            self.guild_id = self.guild_id.id
+        self.interaction: bool = 'interaction_token' in parameters
+        self.major_parameters = ':'.join(_parameter_str(parameters[k]) if k in parameters else ''
+                                         for k in self.MAJOR_PARAMETERS)
+
+    @property
+    def key(self):
+        return f'{self.method} {self.path}'
+
+    @property
+    def bucket(self):
+        return f'{self.major_parameters}:{self.key}'
+
+
+# method, path and the parameters of a route, in path order
+ROUTES = [
+    ('POST', '/channels/{channel_id}/messages', ('channel_id',)),
+    ('PATCH', '/channels/{channel_id}/messages/{message_id}', ('channel_id', 'message_id')),
+    ('GET', '/guilds/{guild_id}/members/{user_id}', ('guild_id', 'user_id')),
+    ('POST', '/interactions/{interaction_id}/{interaction_token}/callback', ('interaction_id', 'interaction_token')),
+]
+
+
+def _values(names, i: int) -> tuple:
+    return tuple(f'token{i}' if n == 'interaction_token' else 1000000000000000000 + i for n in names)
+
+
+def _routes_per_second(build, parameters: list, rounds: int) -> float:
+    """Best of rounds, a round builds a route for every entry of parameters"""
+    best = float('inf')
+    for _ in range(rounds):
+        start = time.perf_counter()
+        for p in parameters:
+            route = build(p)
+            route.url
+            route.bucket
+        best = min(best, time.perf_counter() - start)
+    return len(parameters) / best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--count', type=int, default=50000, help='routes built per round')
+    parser.add_argument('--rounds', type=int, default=5)
+    args = parser.parse_args()
+    print(f'{"route":<64}{"str.replace/s":>15}{"Route/s":>12}{"template/s":>12}')
+    for method, path, names in ROUTES:
+        template = RouteTemplate(method, path)
+        # the same url and bucket, no matter how the route is built
+        kwargs = dict(zip(names, _values(names, 0)))
+        old, new = FormattedRoute(method, path, **kwargs), template(*_values(names, 0))
+        assert (old.url, old.bucket) == (new.url, new.bucket), (old.url, new.url)
+        values = [_values(names, i) for i in range(args.count)]
+        keywords = [dict(zip(names, v)) for v in values]
+        rates = [
+            _routes_per_second(lambda p: FormattedRoute(method, path, **p), keywords, args.rounds),
+            _routes_per_second(lambda p: Route(method, path, **p), keywords, args.rounds),
+            _routes_per_second(lambda p: template(*p), values, args.rounds),
+        ]
+        print(f'{method + " " + path:<64}' + ''.join(f'{r:>{w}.0f}' for r, w in zip(rates, (15, 12, 12))))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+"""Frames/s and allocations per frame of the zlib-stream decompressor.
+
+The stream is generated the way the gateway sends it: one zlib context per connection and a
+Z_SYNC_FLUSH after every payload. Payloads above --split bytes are cut into several websocket
+messages, so the buffered path is measured as well. The implementation from before the buffer
+reuse is run on the same stream for comparison.
+
+    python benchmarks/zlib_stream.py [--guilds N] [--messages N] [--split BYTES] [--rounds N]
+"""
+import argparse
+import time
+import tracemalloc
+import zlib
+from typing import List, Optional
+
+from payloads import gateway_frames
+from distee import utils
+from distee.compression import ZlibStreamDecompressor
+
+
+class UnbufferedDecompressor:
+    """The old implementation, collects every message in a new bytearray"""
+
+    def __init__(self):
+        self._zlib = zlib.decompressobj()
+        self._buffer = bytearray()
+
+    def decompress(self, data: bytes) -> Optional[bytes]:
+        self._buffer.extend(data)
+        if len(data) < 4 or data[-4:] != ZlibStreamDecompressor.SUFFIX:
+            return None
+        data = self._zlib.decompress(self._buffer)
+        self._buffer = bytearray()
+        return data
+
+
+def make_stream(frames, split: int) -> List[bytes]:
+    compressor = zlib.compressobj()
+    stream = []
+    for _, frame in frames:
+        data = compressor.compress(utils.get_json_bytes_from_dict(frame)) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        stream.extend(data[i:i + split] for i in range(0, len(data), split))
+    return stream
+
+
+def frames_per_second(cls, stream: List[bytes], payloads: int, rounds: int) -> float:
+    """Best of rounds, a round inflates the whole stream"""
+    best = float('inf')
+    for _ in range(rounds):
+        # the zlib context belongs to the connection, every round is a new one
+        decompress = cls().decompress
+        start = time.perf_counter()
+        for data in stream:
+            decompress(data)
+        best = min(best, time.perf_counter() - start)
+    return payloads / best
+
+
+def allocated_per_payload(cls, stream: List[bytes], payloads: int) -> float:
+    """Peak bytes allocated on top of the inflated payloads, averaged per payload. Includes the output
+    blocks zlib allocates while inflating (up to 32 KiB for small payloads)"""
+    decompress = cls().decompress
+    extra = 0
+    tracemalloc.start()
+    try:
+        for data in stream:
+            current = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            out = decompress(data)
+            extra += tracemalloc.get_traced_memory()[1] - current - (len(out) if out is not None else 0)
+            del out
+    finally:
+        tracemalloc.stop()
+    return extra / payloads
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--guilds', type=int, default=20)
+    parser.add_argument('--members', type=int, default=100, help='members per guild')
+    parser.add_argument('--messages', type=int, default=2000, help='MESSAGE_CREATE events after the guilds')
+    parser.add_argument('--split', type=int, default=16 * 1024, help='largest websocket message in bytes')
+    parser.add_argument('--rounds', type=int, default=10)
+    args = parser.parse_args()
+    frames = gateway_frames(args.guilds, args.members, args.messages)
+    stream = make_stream(frames, args.split)
+    print(f'{len(frames)} payloads in {len(stream)} websocket messages, '
+          f'{sum(len(d) for d in stream)} bytes compressed')
+    print(f'{"decompressor":<26}{"frames/s":>12}{"extra bytes/frame":>20}')
+    for cls in (ZlibStreamDecompressor, UnbufferedDecompressor):
+        rate = frames_per_second(cls, stream, len(frames), args.rounds)
+        extra = allocated_per_payload(cls, stream, len(frames))
+        print(f'{cls.__name__:<26}{rate:>12.0f}{extra:>20.0f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,15 @@
 from typing import Optional, List, TYPE_CHECKING, Union
-import json
-from distee.route import Route
+from distee.route import RouteTemplate
 from distee.utils import Snowflake
 from distee.message import Message
-from . import utils
 
 if TYPE_CHECKING:
     from distee.channel import MessageableChannel
     from .file import File
 
+CREATE_MESSAGE = RouteTemplate('POST', '/channels/{channel_id}/messages')
+EDIT_MESSAGE = RouteTemplate('PATCH', '/channels/{channel_id}/messages/{message_id}')
+
 
 class Messageable:
 
@@ -33,9 +34,7 @@ class Messageable:
                    files: Optional['File'] = None,
                    flags: Optional[int] = None) -> 'Message':
         channel = await self._get_channel()
-        return await self._client.http.send_message(Route('POST',
-                                                          '/channels/{channel_id}/messages',
-                                                          channel_id=channel.id),
+        return await self._client.http.send_message(CREATE_MESSAGE(channel.id),
                                                     files=files,
                                                     content=content,
                                                     tts=tts,
@@ -54,23 +53,11 @@ class Messageable:
                            embeds: Optional[List[dict]] = None,
                            components: Optional[List] = None,
                            allowed_mentions: Optional[dict] = None) -> 'Message':
-        payload = {'tts': tts}
         channel = await self._get_channel()
-        form = []
-        if content is not None:
-            payload['content'] = content
-        if reply_to is not None:
-            payload['message_reference'] = self._get_reference(reply_to)
-        if embeds is not None:
-            payload['embeds'] = embeds
-        if components is not None:
-            payload['components'] = utils.get_components(components)
-        if allowed_mentions is not None:
-            payload['allowed_mentions'] = allowed_mentions
-        form.append({'name': 'payload_json', 'value': json.dumps(payload)})
-        d = await self._client.http.request(Route('PATCH',
-                                                  '/channels/{channel_id}/messages/{message_id}',
-                                                  channel_id=channel.id,
-                                                  message_id=msg_id),
-                                            form=form)
-        return Message(**d, _client=self._client)
+        return await self._client.http.edit_message(EDIT_MESSAGE(channel.id, msg_id),
+                                                    content=content,
+                                                    tts=tts,
+                                                    message_reference=self._get_reference(reply_to),
+                                                    embeds=embeds,
+                                                    components=components,
+                                                    allowed_mentions=allowed_mentions)
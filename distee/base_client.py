@@ -1,5 +1,6 @@
 import asyncio
 import logging
+import typing
 from typing import Union, List, Optional, Callable, Awaitable, Dict
 
 from distee.application import Application
@@ -18,6 +19,9 @@ from distee.utils import command_lists_equal, Snowflake
 from distee.entitlement import Entitlement
 import re
 
+if typing.TYPE_CHECKING:
+    from distee.gateway import DiscordWebSocket
+
 
 INTER_REGEX = re.compile(r'^([a-zA-Z0-9_]+)_([a-zA-Z0-9|]+)$')
 
@@ -41,6 +45,10 @@ class BaseClient:
         self.message_cache: BaseMessageCache = NoMessageCache()
         self.member_cache: BaseMemberCache = RamMemberCache()
 
+    def _get_websocket(self, guild_id: Optional[int] = None) -> Optional['DiscordWebSocket']:
+        """Returns the web socket responsible for the given guild, None if this process has no connection to it"""
+        return None
+
     async def login(self, token):
         data = await self.http.do_login(token)
         if data is None:
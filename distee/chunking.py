@@ -0,0 +1,290 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import typing
+from typing import Optional, Dict, List, Tuple
+
+if typing.TYPE_CHECKING:
+    from .gateway import DiscordWebSocket
+
+
+class _ChunkRequest:
+
+    __slots__ = ['guild_id', 'priority', 'future', 'nonce', 'attempts', 'timer']
+
+    def __init__(self, guild_id: int, priority: float, future: asyncio.Future):
+        self.guild_id: int = guild_id
+        self.priority: float = priority
+        self.future: asyncio.Future = future
+        self.nonce: Optional[str] = None
+        self.attempts: int = 0
+        self.timer: Optional[asyncio.TimerHandle] = None
+
+
+class MemberChunkScheduler:
+    """Requests the full member list of guilds one at a time, spread over the gateway rate budget of a shard.
+
+    Guilds are requested in order of priority, by default the largest guild first.
+    Every request carries a nonce, the future returned by request() finishes with the last matching chunk.
+    A request that gets no chunk for timeout seconds is sent again, after max_attempts its future is cancelled."""
+
+    def __init__(self, ws: 'DiscordWebSocket', rate: int = 60, per: float = 60.0,
+                 timeout: float = 30.0, max_attempts: int = 3):
+        self.ws: 'DiscordWebSocket' = ws
+        # member requests per `per` seconds, the rest of the gateway budget is left for everything else
+        self.rate: int = rate
+        self.per: float = per
+        self.timeout: float = timeout
+        self.max_attempts: int = max_attempts
+        self.timed_out: int = 0
+        self.requests_sent: int = 0
+        self.completed: int = 0
+        self._pending: Dict[int, _ChunkRequest] = {}
+        self._in_flight: Dict[str, _ChunkRequest] = {}
+        self._heap: List[Tuple[float, int, int]] = []
+        self._counter = itertools.count()
+        self._nonces = itertools.count()
+        self._wakeup: asyncio.Event = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def pending(self) -> int:
+        """number of guilds waiting for their member request to be sent"""
+        return len(self._pending)
+
+    @property
+    def in_flight(self) -> int:
+        """number of sent member requests that are still receiving chunks"""
+        return len(self._in_flight)
+
+    def request(self, guild_id: int, priority: Optional[float] = None) -> asyncio.Future:
+        """Queues a member request for the given guild, lower priorities are sent first.
+
+        Requesting a guild that is already queued only updates its priority if the new one is lower"""
+        for req in self._in_flight.values():
+            if req.guild_id == guild_id:
+                return req.future
+        req = self._pending.get(guild_id)
+        if req is None:
+            req = _ChunkRequest(guild_id, priority if priority is not None else 0.0,
+                                self.ws.loop.create_future())
+            self._pending[guild_id] = req
+        elif priority is None or priority >= req.priority:
+            return req.future
+        else:
+            req.priority = priority
+        heapq.heappush(self._heap, (req.priority, next(self._counter), guild_id))
+        self._wakeup.set()
+        if self._task is None:
+            self._task = self.ws.loop.create_task(self._run())
+        return req.future
+
+    def cancel(self, guild_id: int):
+        """Drops all requests of a guild, e.g. because we left it"""
+        req = self._pending.pop(guild_id, None)
+        if req is not None:
+            req.future.cancel()
+        for nonce in [n for n, r in self._in_flight.items() if r.guild_id == guild_id]:
+            req = self._in_flight.pop(nonce)
+            self._cancel_timer(req)
+            req.future.cancel()
+
+    @staticmethod
+    def _cancel_timer(req: _ChunkRequest):
+        if req.timer is not None:
+            req.timer.cancel()
+            req.timer = None
+
+    def _requeue(self, req: _ChunkRequest):
+        req.nonce = None
+        self._pending[req.guild_id] = req
+        heapq.heappush(self._heap, (req.priority, next(self._counter), req.guild_id))
+        self._wakeup.set()
+
+    def reset(self):
+        """Called after a reconnect, requests in flight may have been lost on the old connection and are queued again"""
+        for req in self._in_flight.values():
+            self._cancel_timer(req)
+            self._requeue(req)
+        self._in_flight.clear()
+
+    def _expire(self, nonce: str):
+        req = self._in_flight.pop(nonce, None)
+        if req is None:
+            return
+        req.timer = None
+        self.timed_out += 1
+        req.attempts += 1
+        if req.attempts >= self.max_attempts:
+            logging.warning(f'gave up requesting the members of guild {req.guild_id} '
+                            f'after {req.attempts} attempts without an answer')
+            req.future.cancel()
+            return
+        logging.debug(f'member request {nonce} of guild {req.guild_id} timed out, requesting it again')
+        self._requeue(req)
+
+    def chunk_received(self, data: dict):
+        req = self._in_flight.get(data.get('nonce'))
+        if req is None:
+            return
+        self._cancel_timer(req)
+        if data.get('chunk_index', 0) < data.get('chunk_count', 1) - 1:
+            # more chunks to come, the timeout counts from the latest one
+            req.timer = self.ws.loop.call_later(self.timeout, self._expire, req.nonce)
+            return
+        del self._in_flight[req.nonce]
+        self.completed += 1
+        if not req.future.done():
+            req.future.set_result(None)
+
+    def _pop(self) -> Optional[_ChunkRequest]:
+        while self._heap:
+            priority, _, gid = heapq.heappop(self._heap)
+            req = self._pending.get(gid)
+            # skip entries that got cancelled or re-queued with a different priority
+            if req is not None and req.priority == priority:
+                del self._pending[gid]
+                return req
+        return None
+
+    async def _run(self):
+        while True:
+            req = self._pop()
+            if req is None:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            if self.ws.socket is None or self.ws.socket.closed:
+                # not connected, try again once the shard is back
+                self._pending[req.guild_id] = req
+                heapq.heappush(self._heap, (req.priority, next(self._counter), req.guild_id))
+                await asyncio.sleep(1.0)
+                continue
+            req.nonce = f'{self.ws.shard_id}:{next(self._nonces)}'
+            self._in_flight[req.nonce] = req
+            try:
+                await self.ws.request_guild_members(req.guild_id, nonce=req.nonce)
+                self.requests_sent += 1
+            except Exception:
+                logging.exception(f'failed to request members of guild {req.guild_id}')
+            # the send can wait for the gateway rate limit, so the timeout starts once it went out
+            if self._in_flight.get(req.nonce) is req and req.timer is None:
+                req.timer = self.ws.loop.call_later(self.timeout, self._expire, req.nonce)
+            await asyncio.sleep(self.per / self.rate)
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        for req in self._in_flight.values():
+            self._cancel_timer(req)
+        for req in itertools.chain(self._pending.values(), self._in_flight.values()):
+            req.future.cancel()
+        self._pending.clear()
+        self._in_flight.clear()
+        self._heap.clear()
+
+
+class MemberLookupBatcher:
+    """Resolves single members over the gateway, lookups of the same guild are collected for a few milliseconds
+    and sent as one member request with up to 100 user ids.
+
+    lookup() returns None if the member was not found or the gateway did not answer in time,
+    callers are expected to fall back to the REST api in that case."""
+
+    NONCE_PREFIX = 'm'
+    MAX_USER_IDS = 100
+
+    def __init__(self, ws: 'DiscordWebSocket', delay: float = 0.005, timeout: float = 5.0):
+        self.ws: 'DiscordWebSocket' = ws
+        self.delay: float = delay
+        self.timeout: float = timeout
+        self.requests_sent: int = 0
+        self.lookups: int = 0
+        self.timeouts: int = 0
+        # waiting lookups by guild and user id, not yet sent
+        self._waiting: Dict[int, Dict[int, asyncio.Future]] = {}
+        # sent lookups by nonce
+        self._in_flight: Dict[str, Dict[int, asyncio.Future]] = {}
+        self._nonces = itertools.count()
+
+    @property
+    def connected(self) -> bool:
+        return self.ws.socket is not None and not self.ws.socket.closed and self.ws.session_id is not None
+
+    def is_lookup(self, data: dict) -> bool:
+        """Returns whether a GUILD_MEMBERS_CHUNK is the answer to one of our lookups"""
+        # by prefix, the lookup is already resolved by the time the event is handled
+        nonce = data.get('nonce')
+        return nonce is not None and nonce.startswith(self.NONCE_PREFIX)
+
+    async def lookup(self, guild_id: int, user_id: int) -> Optional[dict]:
+        """Returns the member payload of the given user or None"""
+        if not self.connected:
+            return None
+        self.lookups += 1
+        waiting = self._waiting.get(guild_id)
+        if waiting is None:
+            waiting = self._waiting[guild_id] = {}
+            self.ws.loop.call_later(self.delay, self._flush, guild_id)
+        fut = waiting.get(user_id)
+        if fut is None:
+            fut = waiting[user_id] = self.ws.loop.create_future()
+        # shield, so one caller giving up does not cancel the lookup for everyone else
+        return await asyncio.shield(fut)
+
+    def _flush(self, guild_id: int):
+        waiting = self._waiting.pop(guild_id, None)
+        if not waiting:
+            return
+        items = list(waiting.items())
+        for i in range(0, len(items), self.MAX_USER_IDS):
+            batch = dict(items[i:i + self.MAX_USER_IDS])
+            nonce = f'{self.NONCE_PREFIX}{self.ws.shard_id}:{next(self._nonces)}'
+            self._in_flight[nonce] = batch
+            self.ws.loop.create_task(self._send(guild_id, nonce, list(batch.keys())))
+            self.ws.loop.call_later(self.timeout, self._expire, nonce)
+
+    async def _send(self, guild_id: int, nonce: str, user_ids: List[int]):
+        try:
+            await self.ws.request_guild_members(guild_id, nonce=nonce, user_ids=user_ids)
+            self.requests_sent += 1
+        except Exception:
+            logging.exception(f'failed to look up members of guild {guild_id}')
+            self._finish(nonce)
+
+    def _expire(self, nonce: str):
+        if nonce in self._in_flight:
+            self.timeouts += 1
+            self._finish(nonce)
+
+    def _finish(self, nonce: str):
+        for fut in self._in_flight.pop(nonce, {}).values():
+            if not fut.done():
+                fut.set_result(None)
+
+    def chunk_received(self, data: dict):
+        batch = self._in_flight.get(data.get('nonce'))
+        if batch is None:
+            return
+        for m in data.get('members', []):
+            fut = batch.get(int(m['user']['id']))
+            if fut is not None and not fut.done():
+                fut.set_result(m)
+        if data.get('chunk_index', 0) >= data.get('chunk_count', 1) - 1:
+            # everything not in the chunks was not found
+            self._finish(data['nonce'])
+
+    def reset(self):
+        """Called on a new session, lookups in flight were lost with the old one"""
+        for nonce in list(self._in_flight.keys()):
+            self._finish(nonce)
+
+    def stop(self):
+        self.reset()
+        for waiting in self._waiting.values():
+            for fut in waiting.values():
+                if not fut.done():
+                    fut.set_result(None)
+        self._waiting.clear()
@@ -2,17 +2,22 @@ import asyncio
 import logging
 import re
 import signal
+import typing
 from typing import Callable, Awaitable, Optional, Union, List, Dict
 
 import aiohttp
 
 from .base_client import BaseClient
-from .gateway import DiscordWebSocket
+from .compression import DEFAULT_TRANSPORT_COMPRESSION
+from .dispatch import BaseEventDispatcher, TaskEventDispatcher, get_event_guild_id
+from .session_store import BaseSessionStore
+from .gateway import DiscordWebSocket, IdentifyLimiter
 from .role import Role
 from .user import User
 from .route import Route
 from .http import HTTPClient
-from .errors import ClientException, ReconnectWebSocket, ConnectionClosed, PriviledgedIntentsRequired
+from .errors import ClientException, ReconnectWebSocket, ConnectionClosed, PriviledgedIntentsRequired, GatewayNotFound, \
+    HTTPException
 from .message import Message
 from .utils import Snowflake, command_lists_equal
 from .flags import Intents
@@ -22,6 +27,9 @@ from .application_command import ApplicationCommand
 from .application import Application
 from .interaction import Interaction
 
+if typing.TYPE_CHECKING:
+    from .recorder import GatewayRecorder
+
 
 def _cancel_tasks(loop: asyncio.AbstractEventLoop) -> None:
     tasks = {t for t in asyncio.all_tasks(loop=loop) if not t.done()}
@@ -83,12 +91,50 @@ class Client(BaseClient):
     def users(self):
         return self._users
 
+    @property
+    def remaining_session_starts(self) -> Optional[int]:
+        """number of identifies left till the daily session start limit resets, None if unknown"""
+        limit = self.identify_limiter.session_start_limit
+        return limit.remaining if limit is not None else None
+
+    @property
+    def latency(self) -> float:
+        """latency of the latest heartbeat in seconds"""
+        return self.ws.latency if self.ws is not None else float('inf')
+
     def __init__(self):
         super().__init__()
         self.ws = None
         self.build_member_cache: bool = True
+        # member requests per minute and shard used to fill the member cache, see MemberChunkScheduler
+        self.member_chunk_rate: int = 60
         self.loop = asyncio.get_event_loop()
         self.intents: Intents = None
+        self.identify_limiter: IdentifyLimiter = IdentifyLimiter()
+        # either json or etf. With etf snowflakes arrive as integers, but payloads are not smaller and the pure
+        # Python decoder costs about 10x the CPU of json (20x of orjson), see benchmarks/codec.py
+        self.gateway_encoding: str = 'json'
+        # zstd-stream if zstandard is installed, otherwise zlib-stream
+        self.transport_compression: Optional[str] = DEFAULT_TRANSPORT_COMPRESSION
+        # drop dispatch events without listener before they are fully decoded (json encoding only)
+        self.selective_dispatch: bool = False
+        # creates the event dispatcher of every shard, e.g. lambda: QueuedEventDispatcher(workers=4)
+        self.event_dispatcher_factory: Callable[[], BaseEventDispatcher] = TaskEventDispatcher
+        # persists the gateway sessions so a restart can resume them instead of identifying again
+        self.session_store: Optional[BaseSessionStore] = None
+        self.session_flush_interval: float = 30.0
+        # records all received gateway frames, see distee.recorder
+        self.gateway_recorder: Optional['GatewayRecorder'] = None
+        # session states by shard id that should be resumed on connect, see DiscordWebSocket.get_session
+        self.resume_sessions: Dict[int, dict] = {}
+        # a resumed session gets no GUILD_CREATE, its guilds are fetched over REST on their first event.
+        # With rehydrate_guilds all of them are fetched right after connecting, which costs 2 requests per guild
+        self.rehydrate_guilds: bool = False
+        self._hydrating: Dict[int, asyncio.Future] = {}
+        # READY arrives once per shard and session, user READY listeners only run once all shards are ready
+        self._ready_shards: set = set()
+        self._ready_dispatched: bool = False
+        self._global_commands: Optional[asyncio.Future] = None
         self.register_raw_gateway_event_listener('READY', self._on_ready)
         self.register_raw_gateway_event_listener('GUILD_CREATE', self._on_guild_create)
         self.register_raw_gateway_event_listener('GUILD_DELETE', self._on_guild_delete)
@@ -122,6 +168,10 @@ class Client(BaseClient):
         self.activity = activity
         await self.ws.update_presence()
 
+    def _get_websocket(self, guild_id: Optional[int] = None) -> Optional[DiscordWebSocket]:
+        """Returns the web socket responsible for the given guild"""
+        return self.ws
+
 ########################################################################################################################
 # EVENT HOOKS
 ########################################################################################################################
@@ -151,7 +201,12 @@ class Client(BaseClient):
         pass
 
     async def _on_voice_state_update(self, data: dict):
+        if data.get('guild_id') is None:
+            return
         guild = self.get_guild(int(data.get('guild_id')))
+        if guild is None:
+            logging.debug(f'skipped voice state update event: guild {int(data["guild_id"])} not present')
+            return
         usr_id = int(data.get('user_id'))
         current = guild.voice_states.get(usr_id)
         if current is None:
@@ -208,6 +263,9 @@ class Client(BaseClient):
 
     async def _on_guild_role_delete(self, data: dict):
         guild = self.get_guild(int(data['guild_id']))
+        if guild is None:
+            logging.debug(f'skipped role delete event: guild {int(data["guild_id"])} not present')
+            return
         role = guild.get_role(int(data['role_id']))
         guild.roles.pop(int(data['role_id']), None)
         if role is not None:
@@ -216,6 +274,9 @@ class Client(BaseClient):
 
     async def _on_guild_role_create(self, data: dict):
         guild = self.get_guild(int(data['guild_id']))
+        if guild is None:
+            logging.debug(f'skipped role create event: guild {int(data["guild_id"])} not present')
+            return
         role = Role(**data['role'], _client=self, _guild=guild)
         guild.roles[role.id] = role
         for event in self._event_listener.get(Event.GUILD_ROLE_CREATED.value, []):
@@ -224,7 +285,10 @@ class Client(BaseClient):
     async def _on_guild_update(self, data: dict):
         g = Guild(**data, _client=self)
         old = self.get_guild(g.id)
-        self._guilds[g.id].handle_guild_update(**data)
+        if old is None:
+            logging.debug(f'skipped guild update event: guild {g.id} not present')
+            return
+        old.handle_guild_update(**data)
         for event in self._event_listener.get(Event.GUILD_UPDATED.value, []):
             asyncio.ensure_future(event(old, g))
 
@@ -263,8 +327,13 @@ class Client(BaseClient):
             asyncio.ensure_future(event(messages))
 
     async def _on_guild_member_chunk(self, data: dict):
-        guild = self.get_guild(int(data['guild_id']))
-        await guild.handle_member_chunk(data)
+        gid = int(data['guild_id'])
+        guild = self.get_guild(gid)
+        ws = self._get_websocket(gid)
+        if guild is not None:
+            await guild.handle_member_chunk(data, quiet=ws is not None and ws.member_lookup.is_lookup(data))
+        if ws is not None:
+            ws.chunk_scheduler.chunk_received(data)
 
     async def _play_guild_member_update(self, data: dict):
         try:
@@ -278,10 +347,15 @@ class Client(BaseClient):
 
     async def _on_guild_member_update(self, data: dict):
         try:
-            guild = self.get_guild(int(data.get('guild_id')))
+            gid = int(data.get('guild_id'))
+            guild = self.get_guild(gid)
             if guild is None:
+                ws = self._get_websocket(gid)
+                if gid not in self._guilds or ws is None or ws.dispatcher.guild_ordered:
+                    # no GUILD_CREATE is coming for a guild we don't know of (or it would have been handled already)
+                    logging.debug(f'skipped member update event: guild {gid} not present')
+                    return
                 # store for later replay
-                gid = int(data.get('guild_id'))
                 if self._member_update_replay.get(gid) is None:
                     self._member_update_replay[gid] = []
                 self._member_update_replay[gid].append(data)
@@ -302,11 +376,35 @@ class Client(BaseClient):
     async def _on_ready(self, data: dict):
         for g in data.get('guilds', []):
             self._guilds[int(g['id'])] = None
-        await self._register_global_commands()
+        await self._ensure_global_commands()
+        await self._shard_ready(data.get('shard', [self.shard_id])[0])
+
+    def _new_session(self, shard_id: int):
+        """Called when a shard is about to identify, READY is dispatched again once it is back"""
+        self._ready_shards.discard(shard_id)
+        self._ready_dispatched = False
+
+    async def _on_shard_resumed(self, shard_id: int):
+        """Called when a session restored after a restart resumed, those never get a READY"""
+        await self._shard_ready(shard_id)
+
+    async def _shard_ready(self, shard_id: int):
+        self._ready_shards.add(shard_id)
+        if self._ready_dispatched or len(self._ready_shards) < len(self._all_websockets()):
+            return
+        self._ready_dispatched = True
         # call ready event
         for event in self._event_listener.get(Event.READY.value, []):
             await event()
 
+    def _ensure_global_commands(self) -> asyncio.Future:
+        """Registers the global commands once per client, no matter how many shards get ready"""
+        task = self._global_commands
+        if task is None or (task.done() and (task.cancelled() or task.exception() is not None)):
+            # first call or the last attempt failed
+            self._global_commands = asyncio.ensure_future(self._register_global_commands())
+        return self._global_commands
+
     async def _on_member_join(self, data: dict):
         gid = int(data.get('guild_id'))
         guild = self.get_guild(gid)
@@ -317,7 +415,7 @@ class Client(BaseClient):
         for event in self._event_listener.get(Event.MEMBER_JOINED.value, []):
             await event(member)
 
-    async def _on_guild_create(self, data: dict):
+    async def _on_guild_create(self, data: dict, chunk_members: bool = True):
         g = Guild(**data, _client=self)
         is_new = g.id not in self._guilds.keys()
         self._guilds[g.id] = g
@@ -325,8 +423,10 @@ class Client(BaseClient):
             dat = self._member_update_replay.pop(g.id)
             for d in dat:
                 asyncio.ensure_future(self._play_guild_member_update(d))
-        if self.build_member_cache:
-            await self.ws.request_guild_members(g.id)
+        ws = self._get_websocket(g.id)
+        if self.build_member_cache and chunk_members and ws is not None:
+            # largest guilds first, they are the most likely to need their members
+            ws.chunk_scheduler.request(g.id, -(g.member_count or 0))
         # register server specific commands on join
         await self._register_guild_commands(g.id)
         if is_new:
@@ -351,6 +451,10 @@ class Client(BaseClient):
                 self._application_commands[ap.id] = ap
 
     async def _on_guild_delete(self, data: dict):
+        # the member request is either pointless or gets queued again by the next GUILD_CREATE
+        ws = self._get_websocket(int(data.get('id')))
+        if ws is not None:
+            ws.chunk_scheduler.cancel(int(data.get('id')))
         if data.get('unavailable') is None:
             # we left the guild
             g = self.get_guild(int(data.get('id')))
@@ -358,7 +462,8 @@ class Client(BaseClient):
                 await event(g)
             # remove from cache
             await self.member_cache.guild_left(int(data.get('id')))
-            self._guilds.pop(int(data.get('id')))
+            self._guilds.pop(int(data.get('id')), None)
+            self._member_update_replay.pop(int(data.get('id')), None)
 
 ########################################################################################################################
 #
@@ -366,6 +471,13 @@ class Client(BaseClient):
 
     async def dispatch_gateway_event(self, event: str, data: dict):
         try:
+            if event not in ('GUILD_CREATE', 'GUILD_DELETE'):
+                gid = get_event_guild_id(event, data)
+                if gid is not None and gid not in self._guilds:
+                    ws = self._get_websocket(gid)
+                    if ws is not None and ws.restored_session:
+                        # first event of a guild we only know from before the restart
+                        await self._hydrate_guild(gid)
             if self.gateway_listener is not None:
                 asyncio.ensure_future(self.gateway_listener(event, data))
             events = self._raw_gateway_listener.get(event)
@@ -376,22 +488,118 @@ class Client(BaseClient):
         except:
             logging.exception('gateway event handling failed')
 
+    def wants_gateway_event(self, event: str) -> bool:
+        """Returns whether a dispatch event has to be decoded and dispatched at all"""
+        return event in ('READY', 'RESUMED') \
+            or self.gateway_listener is not None \
+            or event in self._raw_gateway_listener
+
     def register_raw_gateway_event_listener(self, event_name: str, listener: Callable[[dict], Awaitable[None]]):
         if event_name not in self._raw_gateway_listener.keys():
             self._raw_gateway_listener[event_name] = []
         self._raw_gateway_listener[event_name].append(listener)
 
+    def _all_websockets(self) -> List[DiscordWebSocket]:
+        return [self.ws] if self.ws is not None else []
+
+    def _load_sessions(self):
+        if self.session_store is not None:
+            self.resume_sessions.update(self.session_store.load())
+            self.loop.create_task(self._flush_sessions_task())
+        # resume_sessions can also be handed over directly, e.g. by the ShardSupervisor
+        if any(state.get('session_id') is not None for state in self.resume_sessions.values()):
+            # a resumed session gets no READY, so command callbacks have to be set up here
+            self._ensure_global_commands()
+
+    def _save_sessions(self):
+        if self.session_store is None:
+            return
+        try:
+            self.session_store.save({ws.shard_id: ws.get_session() for ws in self._all_websockets()})
+        except Exception:
+            logging.exception('failed to save gateway sessions')
+
+    async def _flush_sessions_task(self):
+        while not self.is_closed():
+            await asyncio.sleep(self.session_flush_interval)
+            self._save_sessions()
+
+    def _hydrate_guild(self, gid: int) -> asyncio.Future:
+        """Fetches a guild of a restored session over REST, once no matter how many events are waiting for it"""
+        task = self._hydrating.get(gid)
+        if task is None:
+            task = self._hydrating[gid] = asyncio.ensure_future(self._fetch_restored_guild(gid))
+            task.add_done_callback(lambda _: self._hydrating.pop(gid, None))
+        return asyncio.shield(task)
+
+    async def _fetch_restored_guild(self, gid: int):
+        ws = self._get_websocket(gid)
+        # a READY of a new session brings the guilds by itself
+        if ws is None or not ws.restored_session or self._guilds.get(gid) is not None:
+            return
+        try:
+            data = await self.http.request(Route('GET', '/guilds/{guild_id}', guild_id=gid),
+                                           params={'with_counts': 'true'})
+            channels = await self.http.request(Route('GET', '/guilds/{guild_id}/channels', guild_id=gid))
+        except HTTPException:
+            logging.exception(f'could not fetch guild {gid} of a restored session')
+            # known but unavailable, so not every following event tries again
+            self._guilds.setdefault(gid, None)
+            return
+        for c in channels:
+            c.pop('guild_id', None)
+        data['channels'] = channels
+        data.setdefault('member_count', data.get('approximate_member_count'))
+        # members are looked up on demand instead of chunking every guild again
+        await self._on_guild_create(data, chunk_members=False)
+
+    async def _rehydrate_guilds(self, shards: List[DiscordWebSocket]):
+        """Fetches all guilds of sessions restored after a restart right away, see rehydrate_guilds"""
+        shard_ids = {ws.shard_id for ws in shards}
+        guild_ids = []
+        try:
+            while True:
+                page = await self.http.request(Route('GET', '/users/@me/guilds'),
+                                               params={'limit': 200, 'after': guild_ids[-1] if guild_ids else 0})
+                guild_ids.extend(int(g['id']) for g in page)
+                if len(page) < 200:
+                    break
+        except HTTPException:
+            logging.exception('could not list the guilds of the restored sessions')
+            return
+        guild_ids = [gid for gid in guild_ids if (gid >> 22) % self.shard_count in shard_ids]
+        # the global rate limiter spreads these out
+        for i in range(0, len(guild_ids), 25):
+            await asyncio.gather(*[self._hydrate_guild(gid) for gid in guild_ids[i:i + 25]])
+        logging.info(f'fetched {len(guild_ids)} guilds of {len(shards)} restored sessions')
+
+    async def _update_session_start_limit(self):
+        try:
+            data = await self.http.get_bot_gateway()
+        except GatewayNotFound:
+            logging.warning('could not fetch the session start limit, identifying without knowing the budget')
+            return
+        self.identify_limiter.update(data.get('session_start_limit', {}))
+
     async def connect(self):
         """establish web socket connection and let websocket listen for stuff"""
-        self.ws = DiscordWebSocket(self)
-        resume = False
+        self._load_sessions()
+        await self._update_session_start_limit()
+        self.ws = DiscordWebSocket(self, self.shard_id, self.shard_count)
+        resume = self.ws.restore_session(self.resume_sessions.get(self.shard_id))
+        if resume and self.rehydrate_guilds:
+            asyncio.ensure_future(self._rehydrate_guilds([self.ws]))
+        await self._run_websocket(self.ws, resume)
+
+    async def _run_websocket(self, ws: DiscordWebSocket, resume: bool = False):
+        """keep the given web socket running, reconnecting and resuming when possible"""
         while not self.is_closed():
             try:
-                await self.ws.run(resume=resume)
+                await ws.run(resume=resume)
             except ReconnectWebSocket as e:
                 resume = e.resume
                 if resume:
-                    logging.info(f'Trying to resume session...')
+                    logging.info(f'Trying to resume session of shard {ws.shard_id}...')
                 else:
                     logging.info('Reconnect')
                 continue
@@ -408,18 +616,24 @@ class Client(BaseClient):
                 if isinstance(ex, ConnectionClosed):
                     if ex.code == 4014:
                         raise PriviledgedIntentsRequired() from None
-                    if ex.code != 1000:
+                    if ex.code in DiscordWebSocket.FATAL_CLOSE_CODES:
+                        # a reconnect can not fix this and it is the same for every shard
                         await self.close()
                         raise ex
+                    logging.warning(f'shard {ws.shard_id} closed with {ex.code}')
             except asyncio.exceptions.CancelledError:
                 await self.close()
             except:
-                logging.exception('unhandled exception, lets try a reconnect')
-                await self.close()
+                # only this shard is affected, the others keep running
+                logging.exception(f'unhandled exception on shard {ws.shard_id}, lets try a reconnect')
+                await ws.close()
+            if self.is_closed():
+                return
             retry_delay = 2.0
-            logging.exception(f'Attempting to reconnect in {retry_delay:.2f}s')
+            logging.info(f'Attempting to reconnect shard {ws.shard_id} in {retry_delay:.2f}s')
             await asyncio.sleep(retry_delay)
-            resume = True
+            # without a session left there is nothing to resume
+            resume = ws.session_id is not None
 
     async def start(self, token: str):
         await self.login(token)
@@ -430,8 +644,15 @@ class Client(BaseClient):
         if self._closed:
             return
         self._closed = True
+        self._save_sessions()
         await self.http.close()
-        await self.ws.close()
+        if self.gateway_recorder is not None:
+            self.gateway_recorder.close()
+        if self.ws is not None:
+            await self.ws.close()
+            self.ws.chunk_scheduler.stop()
+            self.ws.member_lookup.stop()
+            await self.ws.dispatcher.stop()
 
     def run(self, token: str, intents: Intents = Intents.default()):
         self._closed = False
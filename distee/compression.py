@@ -0,0 +1,105 @@
+import zlib
+from abc import ABC, abstractmethod
+from typing import Optional, Dict, Type
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+class TransportDecompressor(ABC):
+    """Turns the compressed messages of a gateway connection back into complete payloads"""
+
+    name: str = None
+
+    def __init__(self):
+        self.compressed_bytes: int = 0
+        self.uncompressed_bytes: int = 0
+        self.reset()
+
+    @property
+    def ratio(self) -> float:
+        """compression ratio of all data received so far"""
+        return self.uncompressed_bytes / self.compressed_bytes if self.compressed_bytes else 0.0
+
+    @abstractmethod
+    def reset(self):
+        """Start a new stream, called for every new connection"""
+        pass
+
+    @abstractmethod
+    def decompress(self, data: bytes) -> Optional[bytes]:
+        """Feed a received message, returns the payload once it is complete or None if more data is needed"""
+        pass
+
+
+class ZlibStreamDecompressor(TransportDecompressor):
+    """Inflates zlib-stream messages, messages split over multiple frames are collected in a reused buffer"""
+
+    name = 'zlib-stream'
+    SUFFIX = b'\x00\x00\xff\xff'
+    # initial size of the frame buffer and the size it is shrunk back to after very large payloads
+    buffer_size = 64 * 1024
+    max_buffer_size = 4 * 1024 * 1024
+
+    def reset(self):
+        self._zlib = zlib.decompressobj()
+        self._buffer = bytearray(self.buffer_size)
+        self._length = 0
+
+    def decompress(self, data: bytes) -> Optional[bytes]:
+        size = len(data)
+        self.compressed_bytes += size
+        if self._length == 0 and size >= 4 and data[-4:] == self.SUFFIX:
+            # complete message in a single frame, inflate it without copying it into the buffer first
+            data = self._zlib.decompress(data)
+        else:
+            end = self._length + size
+            # grows the buffer if needed, otherwise overwrites the old content in place
+            self._buffer[self._length:end] = data
+            self._length = end
+            # zlib stream not finished
+            if end < 4 or self._buffer[end - 4:end] != self.SUFFIX:
+                return None
+            with memoryview(self._buffer)[:end] as view:
+                data = self._zlib.decompress(view)
+            self._length = 0
+            if len(self._buffer) > self.max_buffer_size:
+                self._buffer = bytearray(self.buffer_size)
+        self.uncompressed_bytes += len(data)
+        return data
+
+
+class ZstdStreamDecompressor(TransportDecompressor):
+
+    name = 'zstd-stream'
+
+    def reset(self):
+        self._zstd = zstandard.ZstdDecompressor().decompressobj()
+
+    def decompress(self, data: bytes) -> Optional[bytes]:
+        # every message is flushed by the gateway, so we always get a full payload back
+        self.compressed_bytes += len(data)
+        data = self._zstd.decompress(data)
+        self.uncompressed_bytes += len(data)
+        return data
+
+
+TRANSPORT_DECOMPRESSORS: Dict[str, Type[TransportDecompressor]] = {
+    ZlibStreamDecompressor.name: ZlibStreamDecompressor
+}
+if zstandard is not None:
+    TRANSPORT_DECOMPRESSORS[ZstdStreamDecompressor.name] = ZstdStreamDecompressor
+
+# use zstd if installed, zlib otherwise
+DEFAULT_TRANSPORT_COMPRESSION = 'zstd-stream' if zstandard is not None else 'zlib-stream'
+
+
+def get_decompressor(name: Optional[str]) -> Optional[TransportDecompressor]:
+    if name is None:
+        return None
+    cls = TRANSPORT_DECOMPRESSORS.get(name)
+    if cls is None:
+        raise ValueError(f'unsupported transport compression {name}')
+    return cls()
@@ -0,0 +1,199 @@
+import asyncio
+import logging
+import time
+import typing
+from abc import ABC, abstractmethod
+from typing import Optional, List, Set
+
+if typing.TYPE_CHECKING:
+    from .client import Client
+
+
+class BaseEventDispatcher(ABC):
+    """Decides how the dispatch events received by a shard get handed to Client.dispatch_gateway_event"""
+
+    # True if all events of a guild are guaranteed to be handled in the order they were received
+    guild_ordered = False
+
+    def __init__(self):
+        self.client: Optional['Client'] = None
+        self.dispatched: int = 0
+
+    def start(self, client: 'Client'):
+        """Called once by the web socket owning this dispatcher"""
+        self.client = client
+
+    @abstractmethod
+    async def submit(self, event: str, data: dict):
+        """Called for every dispatch event, reading from the gateway pauses until this returns"""
+        pass
+
+    async def stop(self):
+        pass
+
+    async def drain(self):
+        """Waits till all submitted events have been handled"""
+        pass
+
+    @property
+    def queue_depth(self) -> int:
+        """number of events received but not yet handled"""
+        return 0
+
+
+class TaskEventDispatcher(BaseEventDispatcher):
+    """Strategy: a new task for every event, no limit and no ordering"""
+
+    def __init__(self):
+        super(TaskEventDispatcher, self).__init__()
+        self._pending: Set[asyncio.Task] = set()
+
+    async def submit(self, event: str, data: dict):
+        self.dispatched += 1
+        task = self.client.loop.create_task(self.client.dispatch_gateway_event(event, data))
+        self._pending.add(task)
+        task.add_done_callback(self._pending.discard)
+
+    async def drain(self):
+        while self._pending:
+            await asyncio.gather(*self._pending, return_exceptions=True)
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._pending)
+
+
+class QueuedEventDispatcher(BaseEventDispatcher):
+    """Strategy: bounded queue consumed by a fixed number of worker tasks.
+
+    Reading from the gateway pauses while high_water_mark events are waiting.
+    With ordered=True a single worker handles all events of the shard in the order they were received."""
+
+    def __init__(self, high_water_mark: int = 1000, workers: int = 8, ordered: bool = False):
+        super(QueuedEventDispatcher, self).__init__()
+        self.high_water_mark: int = high_water_mark
+        self.workers: int = 1 if ordered else workers
+        self.ordered: bool = ordered
+        self.max_queue_depth: int = 0
+        self.paused: int = 0
+        self.time_paused: float = 0.0
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+
+    def start(self, client: 'Client'):
+        super(QueuedEventDispatcher, self).start(client)
+        self._queue = asyncio.Queue(maxsize=self.high_water_mark)
+        self._tasks = [client.loop.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def _worker(self):
+        while True:
+            event, data = await self._queue.get()
+            try:
+                await self.client.dispatch_gateway_event(event, data)
+            except Exception:
+                logging.exception('Exception in event dispatcher')
+            finally:
+                self._queue.task_done()
+
+    async def submit(self, event: str, data: dict):
+        self.dispatched += 1
+        if self._queue.full():
+            # backpressure: stop reading from the gateway till the workers caught up
+            self.paused += 1
+            start = time.perf_counter()
+            await self._queue.put((event, data))
+            self.time_paused += time.perf_counter() - start
+        else:
+            self._queue.put_nowait((event, data))
+        self.max_queue_depth = max(self.max_queue_depth, self._queue.qsize())
+
+    async def drain(self):
+        await self._queue.join()
+
+    async def stop(self):
+        for t in self._tasks:
+            t.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+
+def get_event_guild_id(event: str, data) -> Optional[int]:
+    """Returns the id of the guild a dispatch event belongs to, if any"""
+    if not isinstance(data, dict):
+        return None
+    gid = data.get('guild_id')
+    if gid is None and event in ('GUILD_CREATE', 'GUILD_UPDATE', 'GUILD_DELETE'):
+        gid = data.get('id')
+    return int(gid) if gid is not None else None
+
+
+class GuildLaneEventDispatcher(BaseEventDispatcher):
+    """Strategy: events are spread over ordered lanes by guild id.
+
+    All events of a guild are handled one after another in the order they were received,
+    different guilds are handled concurrently. Events without a guild get their own lane."""
+
+    guild_ordered = True
+
+    def __init__(self, lanes: int = 16, high_water_mark: int = 1000):
+        super(GuildLaneEventDispatcher, self).__init__()
+        self.lanes: int = lanes
+        self.high_water_mark: int = high_water_mark
+        self.max_queue_depth: int = 0
+        self.paused: int = 0
+        self.time_paused: float = 0.0
+        self._queues: List[asyncio.Queue] = []
+        self._tasks: List[asyncio.Task] = []
+
+    def start(self, client: 'Client'):
+        super(GuildLaneEventDispatcher, self).start(client)
+        # the last lane is used for events that don't belong to a guild
+        self._queues = [asyncio.Queue(maxsize=self.high_water_mark) for _ in range(self.lanes + 1)]
+        self._tasks = [client.loop.create_task(self._worker(q)) for q in self._queues]
+
+    async def _worker(self, queue: asyncio.Queue):
+        while True:
+            event, data = await queue.get()
+            try:
+                await self.client.dispatch_gateway_event(event, data)
+            except Exception:
+                logging.exception('Exception in event dispatcher')
+            finally:
+                queue.task_done()
+
+    def _lane(self, guild_id: int) -> int:
+        # the low bits of a snowflake are a per process counter that is nearly always 0, so the timestamp is used.
+        # Its remainder by the shard count is the same for all guilds of a shard and gets divided out
+        return ((guild_id >> 22) // (self.client.shard_count or 1)) % self.lanes
+
+    async def submit(self, event: str, data: dict):
+        self.dispatched += 1
+        gid = get_event_guild_id(event, data)
+        queue = self._queues[self._lane(gid) if gid is not None else self.lanes]
+        if queue.full():
+            # backpressure: stop reading from the gateway till the lane caught up
+            self.paused += 1
+            start = time.perf_counter()
+            await queue.put((event, data))
+            self.time_paused += time.perf_counter() - start
+        else:
+            queue.put_nowait((event, data))
+        self.max_queue_depth = max(self.max_queue_depth, queue.qsize())
+
+    async def drain(self):
+        for queue in self._queues:
+            await queue.join()
+
+    async def stop(self):
+        for t in self._tasks:
+            t.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    @property
+    def queue_depth(self) -> int:
+        return sum(q.qsize() for q in self._queues)
@@ -0,0 +1,197 @@
+import struct
+import zlib
+from enum import Enum
+from typing import Any, Union
+
+FORMAT_VERSION = 131
+
+NEW_FLOAT_EXT = 70
+COMPRESSED = 80
+SMALL_INTEGER_EXT = 97
+INTEGER_EXT = 98
+FLOAT_EXT = 99
+ATOM_EXT = 100
+SMALL_TUPLE_EXT = 104
+LARGE_TUPLE_EXT = 105
+NIL_EXT = 106
+STRING_EXT = 107
+LIST_EXT = 108
+BINARY_EXT = 109
+SMALL_BIG_EXT = 110
+LARGE_BIG_EXT = 111
+SMALL_ATOM_EXT = 115
+MAP_EXT = 116
+ATOM_UTF8_EXT = 118
+SMALL_ATOM_UTF8_EXT = 119
+
+_ATOMS = {
+    'nil': None,
+    'null': None,
+    'true': True,
+    'false': False
+}
+
+_unpack_uint16 = struct.Struct('>H').unpack_from
+_unpack_uint32 = struct.Struct('>I').unpack_from
+_unpack_int32 = struct.Struct('>i').unpack_from
+_unpack_double = struct.Struct('>d').unpack_from
+_pack_uint32 = struct.Struct('>BI').pack
+_pack_int32 = struct.Struct('>Bi').pack
+_pack_double = struct.Struct('>Bd').pack
+
+
+class ETFDecodeError(ValueError):
+    pass
+
+
+class _Decoder:
+
+    __slots__ = ['data', 'pos']
+
+    def __init__(self, data: bytes):
+        self.data = data
+        self.pos = 0
+
+    def _atom(self, length: int):
+        atom = bytes(self.data[self.pos:self.pos + length]).decode('utf-8')
+        self.pos += length
+        return _ATOMS.get(atom, atom)
+
+    def term(self) -> Any:
+        data = self.data
+        tag = data[self.pos]
+        self.pos += 1
+        if tag == BINARY_EXT:
+            length = _unpack_uint32(data, self.pos)[0]
+            self.pos += 4
+            val = bytes(data[self.pos:self.pos + length]).decode('utf-8')
+            self.pos += length
+            return val
+        if tag == MAP_EXT:
+            arity = _unpack_uint32(data, self.pos)[0]
+            self.pos += 4
+            d = {}
+            for _ in range(arity):
+                key = self.term()
+                d[key] = self.term()
+            return d
+        if tag == SMALL_INTEGER_EXT:
+            self.pos += 1
+            return data[self.pos - 1]
+        if tag == INTEGER_EXT:
+            self.pos += 4
+            return _unpack_int32(data, self.pos - 4)[0]
+        if tag in (SMALL_BIG_EXT, LARGE_BIG_EXT):
+            if tag == SMALL_BIG_EXT:
+                n = data[self.pos]
+                self.pos += 1
+            else:
+                n = _unpack_uint32(data, self.pos)[0]
+                self.pos += 4
+            sign = data[self.pos]
+            val = int.from_bytes(data[self.pos + 1:self.pos + 1 + n], 'little')
+            self.pos += 1 + n
+            return -val if sign else val
+        if tag in (SMALL_ATOM_UTF8_EXT, SMALL_ATOM_EXT):
+            self.pos += 1
+            return self._atom(data[self.pos - 1])
+        if tag in (ATOM_UTF8_EXT, ATOM_EXT):
+            self.pos += 2
+            return self._atom(_unpack_uint16(data, self.pos - 2)[0])
+        if tag == NIL_EXT:
+            return []
+        if tag == LIST_EXT:
+            length = _unpack_uint32(data, self.pos)[0]
+            self.pos += 4
+            val = [self.term() for _ in range(length)]
+            tail = self.term()
+            if tail != []:
+                val.append(tail)
+            return val
+        if tag == STRING_EXT:
+            # a list of small integers
+            length = _unpack_uint16(data, self.pos)[0]
+            self.pos += 2
+            val = list(data[self.pos:self.pos + length])
+            self.pos += length
+            return val
+        if tag in (SMALL_TUPLE_EXT, LARGE_TUPLE_EXT):
+            if tag == SMALL_TUPLE_EXT:
+                arity = data[self.pos]
+                self.pos += 1
+            else:
+                arity = _unpack_uint32(data, self.pos)[0]
+                self.pos += 4
+            return tuple(self.term() for _ in range(arity))
+        if tag == NEW_FLOAT_EXT:
+            self.pos += 8
+            return _unpack_double(data, self.pos - 8)[0]
+        if tag == FLOAT_EXT:
+            val = float(bytes(data[self.pos:self.pos + 31]).split(b'\x00', 1)[0])
+            self.pos += 31
+            return val
+        raise ETFDecodeError(f'unknown ETF tag {tag} at position {self.pos - 1}')
+
+
+def decode(data: Union[bytes, bytearray, memoryview]) -> Any:
+    """Decodes a erlang external term format payload as used by the gateway with encoding=etf"""
+    if data[0] != FORMAT_VERSION:
+        raise ETFDecodeError(f'unknown ETF version {data[0]}')
+    if data[1] == COMPRESSED:
+        data = b'\x83' + zlib.decompress(data[6:])
+    decoder = _Decoder(data)
+    decoder.pos = 1
+    return decoder.term()
+
+
+def _encode(obj: Any, buf: bytearray):
+    if obj is None:
+        buf += b'\x77\x03nil'
+    elif obj is True:
+        buf += b'\x77\x04true'
+    elif obj is False:
+        buf += b'\x77\x05false'
+    elif isinstance(obj, Enum):
+        _encode(obj.value, buf)
+    elif isinstance(obj, str):
+        b = obj.encode('utf-8')
+        buf += _pack_uint32(BINARY_EXT, len(b))
+        buf += b
+    elif isinstance(obj, int):
+        if 0 <= obj <= 255:
+            buf.append(SMALL_INTEGER_EXT)
+            buf.append(obj)
+        elif -2 ** 31 <= obj < 2 ** 31:
+            buf += _pack_int32(INTEGER_EXT, obj)
+        else:
+            b = abs(obj).to_bytes((abs(obj).bit_length() + 7) // 8, 'little')
+            buf.append(SMALL_BIG_EXT)
+            buf.append(len(b))
+            buf.append(1 if obj < 0 else 0)
+            buf += b
+    elif isinstance(obj, float):
+        buf += _pack_double(NEW_FLOAT_EXT, obj)
+    elif isinstance(obj, dict):
+        buf += _pack_uint32(MAP_EXT, len(obj))
+        for k, v in obj.items():
+            _encode(k, buf)
+            _encode(v, buf)
+    elif isinstance(obj, (list, tuple)):
+        if len(obj) == 0:
+            buf.append(NIL_EXT)
+            return
+        buf += _pack_uint32(LIST_EXT, len(obj))
+        for v in obj:
+            _encode(v, buf)
+        buf.append(NIL_EXT)
+    elif isinstance(obj, (bytes, bytearray)):
+        buf += _pack_uint32(BINARY_EXT, len(obj))
+        buf += obj
+    else:
+        raise TypeError(f'can not encode object of type {type(obj).__name__} as ETF')
+
+
+def encode(obj: Any) -> bytes:
+    buf = bytearray([FORMAT_VERSION])
+    _encode(obj, buf)
+    return bytes(buf)
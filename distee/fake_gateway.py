@@ -0,0 +1,515 @@
+import asyncio
+import itertools
+import logging
+import time
+import uuid
+import zlib
+from collections import deque
+from typing import Optional, List, Dict, Set, Deque, Tuple
+
+from aiohttp import web, WSMsgType
+
+from . import etf, utils
+from .route import Route
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# first second of 2015, the discord epoch
+DISCORD_EPOCH = 1420070400000
+
+
+def _timestamp() -> str:
+    return time.strftime('%Y-%m-%dT%H:%M:%S.000000+00:00', time.gmtime())
+
+
+class FakeGatewaySession:
+    """Gateway session of one shard, survives reconnects so it can be resumed"""
+
+    def __init__(self, shard_id: int, shard_count: int, history_size: int):
+        self.session_id: str = uuid.uuid4().hex
+        self.shard_id: int = shard_id
+        self.shard_count: int = shard_count
+        self.sequence: int = 0
+        # sent dispatch payloads, replayed on resume
+        self.history: Deque[Tuple[int, dict]] = deque(maxlen=history_size)
+
+
+class FakeGatewayConnection:
+    """A single web socket connection to the FakeGateway"""
+
+    def __init__(self, gateway: 'FakeGateway', ws: web.WebSocketResponse, encoding: str, compress: Optional[str]):
+        self.gateway: 'FakeGateway' = gateway
+        self.ws: web.WebSocketResponse = ws
+        self.encoding: str = encoding
+        self.compress: Optional[str] = compress
+        self.session: Optional[FakeGatewaySession] = None
+        self._compressor = None
+        if compress == 'zlib-stream':
+            self._compressor = zlib.compressobj()
+        elif compress == 'zstd-stream':
+            self._compressor = zstandard.ZstdCompressor().compressobj()
+        self._stream_task: Optional[asyncio.Task] = None
+
+    async def send(self, payload: dict):
+        data = etf.encode(payload) if self.encoding == 'etf' else utils.get_json_bytes_from_dict(payload)
+        if self.compress == 'zlib-stream':
+            data = self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+        elif self.compress == 'zstd-stream':
+            data = self._compressor.compress(data) + self._compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+        if self.compress is None and self.encoding == 'json':
+            await self.ws.send_str(data.decode('utf-8'))
+        else:
+            await self.ws.send_bytes(data)
+        self.gateway.frames_sent += 1
+        self.gateway.bytes_sent += len(data)
+
+    async def dispatch(self, event: str, data: dict):
+        self.session.sequence += 1
+        # same key order as discord, selective dispatch depends on it
+        payload = {'t': event, 's': self.session.sequence, 'op': 0, 'd': data}
+        self.session.history.append((self.session.sequence, payload))
+        self.gateway.events_sent += 1
+        await self.send(payload)
+
+    async def handle(self, msg: dict):
+        op = msg.get('op')
+        data = msg.get('d')
+        if op == 1:
+            await self.send({'op': 11})
+        elif op == 2:
+            await self._identify(data)
+        elif op == 6:
+            await self._resume(data)
+        elif op == 8:
+            await self._request_guild_members(data)
+        elif op == 3:
+            pass
+        else:
+            logging.warning(f'fake gateway: unexpected OP code {op}')
+
+    async def _identify(self, data: dict):
+        if self.session is not None:
+            await self.ws.close(code=4005)
+            return
+        self.gateway.identifies += 1
+        shard_id, shard_count = data.get('shard', [0, 1])
+        self.session = FakeGatewaySession(shard_id, shard_count, self.gateway.history_size)
+        self.gateway.sessions[self.session.session_id] = self.session
+        guilds = self.gateway.get_shard_guilds(shard_id, shard_count)
+        await self.dispatch('READY', self.gateway.make_ready(self.session.session_id, shard_id, shard_count))
+        for gid in guilds:
+            await self.dispatch('GUILD_CREATE', self.gateway.make_guild(gid))
+        self._start_stream()
+
+    async def _resume(self, data: dict):
+        session = self.gateway.sessions.get(data.get('session_id'))
+        seq = data.get('seq') or 0
+        if session is None or (session.history and session.history[0][0] > seq + 1):
+            # unknown session or the missed events are no longer buffered
+            await self.send({'op': 9, 'd': False})
+            return
+        self.gateway.resumes += 1
+        self.session = session
+        for s, payload in list(session.history):
+            if s > seq:
+                await self.send(payload)
+        await self.dispatch('RESUMED', {'_trace': ['fake-gateway']})
+        self._start_stream()
+
+    async def _request_guild_members(self, data: dict):
+        gid = int(data['guild_id'])
+        if gid not in self.gateway.guilds:
+            return
+        user_ids = data.get('user_ids')
+        if user_ids is not None:
+            if not isinstance(user_ids, list):
+                user_ids = [user_ids]
+            members = [self.gateway.make_member(gid, int(uid)) for uid in user_ids
+                       if self.gateway.is_member(gid, int(uid))]
+            not_found = [str(uid) for uid in user_ids if not self.gateway.is_member(gid, int(uid))]
+        else:
+            limit = data.get('limit') or self.gateway.members_per_guild
+            members = [self.gateway.make_member(gid, uid)
+                       for uid in itertools.islice(self.gateway.get_member_ids(gid), limit)]
+            not_found = []
+        chunks = [members[i:i + 1000] for i in range(0, len(members), 1000)] or [[]]
+        for i, chunk in enumerate(chunks):
+            d = {
+                'guild_id': str(gid),
+                'members': chunk,
+                'chunk_index': i,
+                'chunk_count': len(chunks)
+            }
+            if i == 0 and not_found:
+                d['not_found'] = not_found
+            if data.get('nonce') is not None:
+                d['nonce'] = data['nonce']
+            await self.dispatch('GUILD_MEMBERS_CHUNK', d)
+
+    def _start_stream(self):
+        if self.gateway.message_rate > 0 and self._stream_task is None:
+            self._stream_task = asyncio.get_event_loop().create_task(self._message_stream())
+
+    async def _message_stream(self):
+        guilds = self.gateway.get_shard_guilds(self.session.shard_id, self.session.shard_count)
+        if not guilds:
+            return
+        targets = itertools.cycle(guilds)
+        due = 0.0
+        last = time.perf_counter()
+        while not self.ws.closed:
+            await asyncio.sleep(self.gateway.tick)
+            now = time.perf_counter()
+            due += (now - last) * self.gateway.message_rate
+            last = now
+            # sleeping per message is far too coarse for high rates, send whatever is due every tick
+            try:
+                while due >= 1.0 and not self.ws.closed:
+                    due -= 1.0
+                    await self.dispatch('MESSAGE_CREATE', self.gateway.make_message(next(targets)))
+            except ConnectionResetError:
+                # client went away mid tick
+                return
+
+    def stop(self):
+        if self._stream_task is not None:
+            self._stream_task.cancel()
+            self._stream_task = None
+
+
+class FakeGateway:
+    """aiohttp server that imitates the discord gateway and the REST endpoints a client needs to start.
+
+    Serves a synthetic set of guilds and optionally a stream of MESSAGE_CREATE events, so the
+    event throughput and the reconnect paths of a client can be tested without discord::
+
+        gateway = FakeGateway(guilds=100, members_per_guild=500, message_rate=5000)
+        await gateway.start()
+        gateway.point_client(client)
+        await client.start('fake-token')
+    """
+
+    def __init__(self,
+                 guilds: int = 10,
+                 members_per_guild: int = 100,
+                 channels_per_guild: int = 10,
+                 message_rate: float = 0.0,
+                 shard_count: int = 1,
+                 heartbeat_interval: int = 41250,
+                 history_size: int = 10000,
+                 host: str = '127.0.0.1',
+                 port: int = 0):
+        self.guild_count: int = guilds
+        self.members_per_guild: int = members_per_guild
+        self.channels_per_guild: int = channels_per_guild
+        # MESSAGE_CREATE events per second and connection
+        self.message_rate: float = message_rate
+        self.tick: float = 0.01
+        self.shard_count: int = shard_count
+        self.heartbeat_interval: int = heartbeat_interval
+        self.history_size: int = history_size
+        self.host: str = host
+        self.port: int = port
+        self.application_id: int = self._snowflake(0, 1)
+        self.user: dict = {
+            'id': str(self.application_id),
+            'username': 'FakeBot',
+            'discriminator': '0',
+            'avatar': None,
+            'bot': True
+        }
+        self.guilds: Set[int] = {self._snowflake(i + 1, 0) for i in range(guilds)}
+        self.sessions: Dict[str, FakeGatewaySession] = {}
+        self.connections: List[FakeGatewayConnection] = []
+        self.identifies: int = 0
+        self.resumes: int = 0
+        self.events_sent: int = 0
+        self.frames_sent: int = 0
+        self.bytes_sent: int = 0
+        self._ids = itertools.count(1)
+        self._runner: Optional[web.AppRunner] = None
+
+    @staticmethod
+    def _snowflake(ms: int, increment: int) -> int:
+        return ((ms + 1000000) << 22) | (increment & 0xfff)
+
+    @property
+    def url(self) -> str:
+        return f'http://{self.host}:{self.port}'
+
+    @property
+    def api_url(self) -> str:
+        return f'{self.url}/api/v{utils.API_VERSION}'
+
+    @property
+    def gateway_url(self) -> str:
+        return f'ws://{self.host}:{self.port}/gateway'
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get('/gateway', self._on_websocket)
+        app.router.add_route('*', '/api/v{version}/{path:.*}', self._on_rest)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        if self.port == 0:
+            self.port = site._server.sockets[0].getsockname()[1]
+        logging.info(f'fake gateway listening on {self.url}')
+
+    async def stop(self):
+        for conn in list(self.connections):
+            conn.stop()
+            await conn.ws.close()
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    def point_client(self, client):
+        """Makes the given client use this server for the gateway and all REST requests"""
+        client.http.gateway_url = self.gateway_url
+        Route.BASE_URL = self.api_url
+
+    async def request_reconnect(self):
+        """Sends OP 7 to all connected clients"""
+        for conn in list(self.connections):
+            await conn.send({'op': 7, 'd': None})
+
+    async def invalidate_sessions(self, resumable: bool = False):
+        """Sends OP 9 to all connected clients, forgetting their sessions unless resumable"""
+        for conn in list(self.connections):
+            if not resumable and conn.session is not None:
+                self.sessions.pop(conn.session.session_id, None)
+                conn.session = None
+            conn.stop()
+            await conn.send({'op': 9, 'd': resumable})
+
+    async def drop_connections(self, code: int = 4000):
+        """Closes all connections like a network failure would"""
+        for conn in list(self.connections):
+            conn.stop()
+            await conn.ws.close(code=code)
+
+    ####################################################################################################################
+    # synthetic data
+    ####################################################################################################################
+
+    def get_shard_guilds(self, shard_id: int, shard_count: int) -> List[int]:
+        return sorted(gid for gid in self.guilds if (gid >> 22) % shard_count == shard_id)
+
+    def get_member_ids(self, gid: int):
+        return (gid + 1 + i for i in range(self.members_per_guild))
+
+    def is_member(self, gid: int, uid: int) -> bool:
+        return gid < uid <= gid + self.members_per_guild
+
+    def make_ready(self, session_id: str, shard_id: int = 0, shard_count: int = 1) -> dict:
+        return {
+            'v': utils.GATEWAY_VERSION,
+            'user': self.user,
+            'guilds': [{'id': str(gid), 'unavailable': True} for gid in self.get_shard_guilds(shard_id, shard_count)],
+            'session_id': session_id,
+            'resume_gateway_url': self.gateway_url,
+            'shard': [shard_id, shard_count],
+            'application': {'id': str(self.application_id), 'flags': 0},
+            '_trace': ['fake-gateway']
+        }
+
+    def make_user(self, uid: int) -> dict:
+        return {
+            'id': str(uid),
+            'username': f'user{uid % 100000}',
+            'discriminator': '0',
+            'global_name': None,
+            'avatar': None
+        }
+
+    def make_member(self, gid: int, uid: int) -> dict:
+        return {
+            'user': self.make_user(uid),
+            'nick': None,
+            'roles': [],
+            'joined_at': _timestamp(),
+            'deaf': False,
+            'mute': False,
+            'flags': 0
+        }
+
+    def make_channel(self, gid: int, position: int) -> dict:
+        return {
+            'id': str(gid + self.members_per_guild + 1 + position),
+            'type': 0,
+            'name': f'channel-{position}',
+            'position': position,
+            'topic': None,
+            'nsfw': False,
+            'parent_id': None,
+            'permission_overwrites': []
+        }
+
+    def make_guild(self, gid: int) -> dict:
+        large = self.members_per_guild > 250
+        return {
+            'id': str(gid),
+            'name': f'Guild {gid}',
+            'icon': None,
+            'splash': None,
+            'discovery_splash': None,
+            'owner_id': str(gid + 1),
+            'afk_channel_id': None,
+            'afk_timeout': 300,
+            'verification_level': 0,
+            'default_message_notifications': 0,
+            'explicit_content_filter': 0,
+            'roles': [{
+                'id': str(gid),
+                'name': '@everyone',
+                'color': 0,
+                'hoist': False,
+                'position': 0,
+                'permissions': '1071698660929',
+                'managed': False,
+                'mentionable': False
+            }],
+            'emojis': [],
+            'features': [],
+            'mfa_level': 0,
+            'system_channel_id': None,
+            'system_channel_flags': 0,
+            'rules_channel_id': None,
+            'vanity_url_code': None,
+            'description': None,
+            'banner': None,
+            'premium_tier': 0,
+            'preferred_locale': 'en-US',
+            'nsfw_level': 0,
+            'joined_at': _timestamp(),
+            'large': large,
+            'unavailable': False,
+            'member_count': self.members_per_guild,
+            'voice_states': [],
+            # large guilds only contain the bot itself, everyone else has to be requested
+            'members': [self.make_member(gid, uid) for uid in
+                        itertools.islice(self.get_member_ids(gid), 0 if large else self.members_per_guild)],
+            'channels': [self.make_channel(gid, i) for i in range(self.channels_per_guild)],
+            'threads': [],
+            'stage_instances': []
+        }
+
+    def make_message(self, gid: int) -> dict:
+        n = next(self._ids)
+        uid = gid + 1 + n % max(self.members_per_guild, 1)
+        member = self.make_member(gid, uid)
+        return {
+            'id': str(self._snowflake(int(time.time() * 1000) - DISCORD_EPOCH, n)),
+            'channel_id': str(gid + self.members_per_guild + 1 + n % max(self.channels_per_guild, 1)),
+            'guild_id': str(gid),
+            'author': member.pop('user'),
+            'member': member,
+            'content': f'message {n}',
+            'timestamp': _timestamp(),
+            'edited_timestamp': None,
+            'tts': False,
+            'mention_everyone': False,
+            'mentions': [],
+            'mention_roles': [],
+            'attachments': [],
+            'embeds': [],
+            'pinned': False,
+            'type': 0
+        }
+
+    ####################################################################################################################
+    # handlers
+    ####################################################################################################################
+
+    async def _on_websocket(self, request: web.Request):
+        encoding = request.query.get('encoding', 'json')
+        compress = request.query.get('compress')
+        if compress not in (None, 'zlib-stream', 'zstd-stream') or (compress == 'zstd-stream' and zstandard is None):
+            raise web.HTTPBadRequest(text=f'unsupported compression {compress}')
+        ws = web.WebSocketResponse(max_msg_size=0)
+        await ws.prepare(request)
+        conn = FakeGatewayConnection(self, ws, encoding, compress)
+        self.connections.append(conn)
+        try:
+            await conn.send({'op': 10, 'd': {'heartbeat_interval': self.heartbeat_interval}})
+            async for msg in ws:
+                if msg.type == WSMsgType.TEXT:
+                    await conn.handle(utils.get_dict_from_json(msg.data))
+                elif msg.type == WSMsgType.BINARY:
+                    await conn.handle(etf.decode(msg.data))
+        finally:
+            conn.stop()
+            self.connections.remove(conn)
+        return ws
+
+    async def _on_rest(self, request: web.Request):
+        path = '/' + request.match_info['path']
+        if path == '/gateway':
+            return self._json({'url': self.gateway_url})
+        if path == '/gateway/bot':
+            return self._json({
+                'url': self.gateway_url,
+                'shards': self.shard_count,
+                'session_start_limit': {
+                    'total': 1000,
+                    'remaining': 1000 - self.identifies,
+                    'reset_after': 86400000,
+                    'max_concurrency': 1
+                }
+            })
+        if path == '/users/@me':
+            return self._json(self.user)
+        if path == '/oauth2/applications/@me':
+            return self._json({'id': str(self.application_id), 'name': 'FakeBot', 'description': ''})
+        if path.endswith('/commands'):
+            if request.method == 'GET':
+                return self._json([])
+            body = await request.json()
+            if request.method == 'PUT':
+                return self._json([self._command(c) for c in body])
+            return self._json(self._command(body))
+        if path == '/users/@me/guilds':
+            after = int(request.query.get('after', 0))
+            limit = int(request.query.get('limit', 200))
+            return self._json([{'id': str(gid), 'name': f'Guild {gid}'}
+                               for gid in sorted(self.guilds) if gid > after][:limit])
+        if request.method == 'GET' and path.startswith('/guilds/'):
+            parts = path.split('/')
+            gid = int(parts[2]) if parts[2].isdigit() else None
+            if gid in self.guilds and len(parts) == 3:
+                guild = self.make_guild(gid)
+                # the REST guild object has none of the GUILD_CREATE extras
+                for k in ('joined_at', 'large', 'unavailable', 'member_count', 'voice_states', 'members',
+                          'channels', 'threads', 'stage_instances'):
+                    guild.pop(k)
+                guild['approximate_member_count'] = self.members_per_guild
+                return self._json(guild)
+            if gid in self.guilds and parts[3:] == ['channels']:
+                return self._json([dict(self.make_channel(gid, i), guild_id=str(gid))
+                                   for i in range(self.channels_per_guild)])
+        # echo everything else, good enough for fire and forget requests
+        if request.can_read_body:
+            body = await request.read()
+            if request.content_type == 'application/json':
+                data = utils.get_dict_from_json(body)
+                if isinstance(data, dict):
+                    data.setdefault('id', str(self._snowflake(int(time.time() * 1000) - DISCORD_EPOCH,
+                                                              next(self._ids))))
+                return self._json(data)
+        if request.method == 'GET':
+            return web.Response(status=404, body=utils.get_json_bytes_from_dict({'message': 'Unknown', 'code': 0}),
+                                content_type='application/json')
+        return web.Response(status=204)
+
+    def _command(self, data: dict) -> dict:
+        return dict(data, id=str(self._snowflake(0, next(self._ids))), application_id=str(self.application_id),
+                    version='1')
+
+    @staticmethod
+    def _json(data) -> web.Response:
+        return web.Response(body=utils.get_json_bytes_from_dict(data), content_type='application/json')
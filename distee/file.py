@@ -1,16 +1,86 @@
-
 import io
+import mmap
+import os
+from typing import Optional, Union
 
 
 class File:
+    """A file to attach to a message.
+
+    fp can be a readable binary file object, a path or a file descriptor. Files are streamed in chunks when sent,
+    with use_mmap a file on disk is sent straight from a read only memory map instead."""
 
-    def __init__(self, fp: 'io.BufferedIOBase', name: str, description: str):
+    def __init__(self,
+                 fp: Union['io.BufferedIOBase', str, os.PathLike, int],
+                 name: Optional[str] = None,
+                 description: Optional[str] = None,
+                 use_mmap: bool = False):
+        is_path = isinstance(fp, (str, bytes, os.PathLike))
+        # files we opened ourselves are closed by close(), everything else belongs to the caller
+        self._owned: bool = is_path or isinstance(fp, int)
+        if isinstance(fp, int):
+            fp = open(fp, 'rb', closefd=False)
+        elif is_path:
+            if name is None:
+                name = os.path.basename(os.fsdecode(fp))
+            fp = open(fp, 'rb')
+        # anything else is used as a stream, it only needs read, seek and tell
         self.fp: 'io.BufferedIOBase' = fp
+        if name is None:
+            # files opened from an fd have the fd number as name
+            fp_name = getattr(fp, 'name', None)
+            name = os.path.basename(os.fsdecode(fp_name)) if isinstance(fp_name, (str, bytes)) else 'file'
         self.filename = name
         self.spoiler: bool = False
         self.description = description
         self._original_pos = fp.tell()
+        self._mmap: Optional[mmap.mmap] = None
+        if use_mmap and self.on_disk and self.size:
+            self._mmap = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+    @property
+    def on_disk(self) -> bool:
+        """whether reads can block on the disk, those are done outside of the event loop"""
+        try:
+            self.fp.fileno()
+        except (AttributeError, OSError):
+            return False
+        return True
+
+    @property
+    def size(self) -> Optional[int]:
+        """bytes left to send from the original position, None if unknown"""
+        try:
+            return os.fstat(self.fp.fileno()).st_size - self._original_pos
+        except (AttributeError, OSError):
+            pass
+        if isinstance(self.fp, io.BytesIO):
+            return self.fp.getbuffer().nbytes - self._original_pos
+        return None
+
+    def view(self) -> Optional[memoryview]:
+        """The memory mapped contents from the original position, None without use_mmap"""
+        if self._mmap is None:
+            return None
+        return memoryview(self._mmap)[self._original_pos:]
 
     def reset(self, seek=True):
         if seek:
             self.fp.seek(self._original_pos)
+
+    def close(self):
+        if self._mmap is not None:
+            try:
+                self._mmap.close()
+            except BufferError:
+                # a transport still holds a view of it, gets closed once that is gone
+                pass
+            self._mmap = None
+        if self._owned:
+            self.fp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -1,48 +1,91 @@
 import asyncio
-import json
+import heapq
 import logging
-import threading
+import random
+import re
 import time
-import zlib
-from . import utils
+from collections import deque
+from . import utils, etf
 
 import aiohttp
 from aiohttp import ClientWebSocketResponse
-from concurrent import futures
+from .chunking import MemberChunkScheduler, MemberLookupBatcher
+from .compression import TransportDecompressor, get_decompressor
+from .dispatch import BaseEventDispatcher
 from .errors import WebSocketClosure, ReconnectWebSocket, ConnectionClosed
 from platform import platform
+from typing import Dict, Optional, Deque, Tuple, List
 
 
-class HeartbeatThread(threading.Thread):
+class LatencyHistogram:
+    """Rolling window of the latest heartbeat latencies of a shard"""
 
-    def __init__(self, ws, interval):
-        super(HeartbeatThread, self).__init__()
+    BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, size: int = 100, buckets: Tuple[float, ...] = BUCKETS):
+        self.samples: Deque[float] = deque(maxlen=size)
+        self.buckets: Tuple[float, ...] = buckets
+
+    def add(self, latency: float):
+        self.samples.append(latency)
+
+    @property
+    def last(self) -> float:
+        """the latest latency, inf if there was no heartbeat ack yet"""
+        return self.samples[-1] if self.samples else float('inf')
+
+    def percentile(self, p: float) -> float:
+        if not self.samples:
+            return float('inf')
+        s = sorted(self.samples)
+        return s[min(len(s) - 1, int(len(s) * p / 100.0))]
+
+    def histogram(self) -> Dict[float, int]:
+        """number of samples per bucket, keyed by the upper bound of the bucket"""
+        counts = {b: 0 for b in self.buckets}
+        counts[float('inf')] = 0
+        for sample in self.samples:
+            for b in counts:
+                if sample <= b:
+                    counts[b] += 1
+                    break
+        return counts
+
+
+class HeartbeatManager:
+    """Sends heartbeats from a task on the loop and detects connections that stopped acknowledging them"""
+
+    def __init__(self, ws, interval: float):
         self.ws: 'DiscordWebSocket' = ws
-        self.stop_event = threading.Event()
-        self.interval = interval
+        self.interval: float = interval
+        self._task: Optional[asyncio.Task] = None
+        self._ack_pending: bool = False
         self._last_recv = time.perf_counter()
-        self.heartbeat_timeout = 60
-        self.latency = float('inf')
         self._last_send = time.perf_counter()
         self._last_ack = time.perf_counter()
 
-    def run(self) -> None:
-        while not self.stop_event.wait(self.interval):
-            f = asyncio.run_coroutine_threadsafe(self.ws.send_heartbeat(), loop=self.ws.loop)
+    def start(self):
+        self._task = self.ws.loop.create_task(self._run())
+
+    async def _run(self):
+        # the first heartbeat is jittered so reconnecting shards don't all beat at the same time
+        await asyncio.sleep(self.interval * random.random())
+        while True:
+            if self._ack_pending:
+                logging.warning(f'Shard {self.ws.shard_id} did not receive a heartbeat ack, '
+                                f'connection is zombied, forcing a resume')
+                # detach so closing the socket does not cancel this task mid close
+                self._task = None
+                await self.ws.close()
+                return
+            self._ack_pending = True
+            self._last_send = time.perf_counter()
             try:
-                # block until sending is complete
-                total = 0
-                while True:
-                    try:
-                        f.result(10)
-                        break
-                    except futures.TimeoutError:
-                        total += 10
-                        logging.exception('Exception in heartbeat thread')
+                await self.ws.send_heartbeat()
             except Exception:
-                self.stop()
-            else:
-                self._last_send = time.perf_counter()
+                logging.exception('Exception while sending heartbeat')
+                return
+            await asyncio.sleep(self.interval)
 
     def get_payload(self):
         return {
@@ -56,41 +99,177 @@ class HeartbeatThread(threading.Thread):
     def ack(self):
         ack_time = time.perf_counter()
         self._last_ack = ack_time
-        self.latency = ack_time - self._last_send
-        if self.latency > 10:
-            logging.warning(f'Can\'t keep up, gateway is {self.latency:.2f}s behind')
-        pass
+        self._ack_pending = False
+        latency = ack_time - self._last_send
+        self.ws.latency_histogram.add(latency)
+        if latency > 10:
+            logging.warning(f'Can\'t keep up, gateway is {latency:.2f}s behind')
 
     def stop(self):
-        self.stop_event.set()
+        if self._task is not None and self._task is not asyncio.current_task():
+            self._task.cancel()
+        self._task = None
 
 
 class GatewayRateLimiter:
-
-    def __init__(self):
-        self.lock: asyncio.Lock = asyncio.Lock()
-        self.remaining = 110
-        self.max = 110
-        self.window = 0.0
-        self.per = 60.0
-
-    def get_delay(self):
-        current = time.time()
-        if current > self.window + self.per:
-            self.remaining = self.max
-        if self.remaining == self.max:
-            self.window = current
-        if self.remaining == 0:
-            return self.per - (current - self.window)
+    """Token bucket for gateway sends, waiting sends are served by priority.
+
+    Tokens refill at rate per `per` seconds and at most burst tokens can be saved up, so no window of `per` seconds
+    ever sees more than rate + burst sends. The last reserved tokens can only be used by heartbeats."""
+
+    HEARTBEAT = 0
+    IDENTIFY = 1
+    RESUME = 1
+    REQUEST_MEMBERS = 2
+    DEFAULT = 2
+    PRESENCE = 3
+
+    def __init__(self, rate: int = 110, per: float = 60.0, burst: int = 10, reserved: int = 3):
+        # everything but heartbeats needs reserved + 1 tokens, the bucket has to be able to hold them
+        if not 0 <= reserved < burst:
+            raise ValueError(f'reserved has to be at least 0 and less than burst ({burst}), got {reserved}')
+        self.rate: int = rate
+        self.per: float = per
+        self.burst: int = burst
+        self.reserved: int = reserved
+        self.tokens: float = float(burst)
+        self._last = time.monotonic()
+        self._waiters: List[Tuple[int, int, asyncio.Future]] = []
+        self._counter = 0
+        self._timer: Optional[asyncio.TimerHandle] = None
+        # queue wait statistics by priority
+        self.sends: Dict[int, int] = {}
+        self.total_wait: Dict[int, float] = {}
+        self.max_wait: Dict[int, float] = {}
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(float(self.burst), self.tokens + (now - self._last) * self.rate / self.per)
+        self._last = now
+
+    def _needed(self, priority: int) -> int:
+        return 1 if priority == self.HEARTBEAT else 1 + self.reserved
+
+    def _wake(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        self._refill()
+        while self._waiters:
+            priority, _, fut = self._waiters[0]
+            if fut.done():
+                heapq.heappop(self._waiters)
+                continue
+            if self.tokens < self._needed(priority):
+                break
+            heapq.heappop(self._waiters)
+            self.tokens -= 1
+            fut.set_result(None)
+        if self._waiters:
+            missing = self._needed(self._waiters[0][0]) - self.tokens
+            self._timer = asyncio.get_event_loop().call_later(missing * self.per / self.rate, self._wake)
+
+    def _record(self, priority: int, waited: float):
+        self.sends[priority] = self.sends.get(priority, 0) + 1
+        self.total_wait[priority] = self.total_wait.get(priority, 0.0) + waited
+        if waited > self.max_wait.get(priority, 0.0):
+            self.max_wait[priority] = waited
+
+    async def block(self, priority: int = DEFAULT):
+        start = time.monotonic()
+        self._refill()
+        if not self._waiters and self.tokens >= self._needed(priority):
+            self.tokens -= 1
+            self._record(priority, 0.0)
+            return
+        fut = asyncio.get_event_loop().create_future()
+        heapq.heappush(self._waiters, (priority, self._counter, fut))
+        self._counter += 1
+        self._wake()
+        await fut
+        waited = time.monotonic() - start
+        if waited > 5.0:
+            logging.warning('WebSocket is ratelimited, waited %.2f seconds', waited)
+        self._record(priority, waited)
+
+
+# start of a dispatch frame as sent by the gateway, frames with a different layout are always fully decoded
+DISPATCH_HEADER = re.compile(rb'\{"t":"([A-Z0-9_]+)","s":(\d+),"op":0,')
+# the same for text frames, which is what the gateway sends without transport compression
+DISPATCH_HEADER_STR = re.compile(DISPATCH_HEADER.pattern.decode('ascii'))
+
+
+class SessionStartLimit:
+    """Daily identify budget of the bot as reported by /gateway/bot, every identify uses one session start"""
+
+    def __init__(self, data: dict):
+        self.total: int = data.get('total', 1000)
+        self.remaining: int = data.get('remaining', self.total)
+        self.max_concurrency: int = data.get('max_concurrency', 1)
+        self.reset_at: float = time.monotonic() + data.get('reset_after', 0) / 1000.0
+        self.used: int = 0
+
+    def consume(self) -> float:
+        """Uses one session start, returns how many seconds to wait before identifying with it"""
+        now = time.monotonic()
+        if now >= self.reset_at:
+            self.remaining = self.total
+            self.reset_at = now + 86400.0
+        delay = 0.0
+        if self.remaining <= 0:
+            # identifying now would get the token reset, wait for the next budget instead
+            delay = self.reset_at - now
+            self.remaining = self.total
+            self.reset_at += 86400.0
         self.remaining -= 1
-        return 0.0
-
-    async def block(self):
-        async with self.lock:
-            delta = self.get_delay()
-            if delta:
-                logging.warning('WebSocket is ratelimited, waiting %.2f seconds', delta)
-                await asyncio.sleep(delta)
+        self.used += 1
+        return delay
+
+
+class IdentifyLimiter:
+    """Makes sure only one shard per rate_limit_key (shard_id % max_concurrency) identifies every 5 seconds
+    and that the daily session start limit is never exceeded"""
+
+    def __init__(self, max_concurrency: int = 1):
+        self.max_concurrency = max_concurrency
+        self.per = 5.0
+        self.session_start_limit: Optional[SessionStartLimit] = None
+        self._locks: Dict[int, asyncio.Lock] = {}
+
+    def update(self, session_start_limit: dict):
+        """Takes the session_start_limit reported by /gateway/bot"""
+        self.session_start_limit = SessionStartLimit(session_start_limit)
+        self.max_concurrency = self.session_start_limit.max_concurrency
+        logging.info(f'{self.session_start_limit.remaining} of {self.session_start_limit.total} session starts '
+                     f'remaining (max concurrency: {self.max_concurrency})')
+
+    def _lock(self, shard_id: int) -> asyncio.Lock:
+        key = shard_id % self.max_concurrency
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = asyncio.Lock()
+            self._locks[key] = lock
+        return lock
+
+    async def block(self, shard_id: int):
+        """Waits for the identify slot of the shard, release() has to be called once the identify was sent"""
+        lock = self._lock(shard_id)
+        await lock.acquire()
+        try:
+            if self.session_start_limit is not None:
+                delay = self.session_start_limit.consume()
+                if delay > 0:
+                    logging.error(f'session start limit used up, shard {shard_id} waits {delay:.0f}s for the reset')
+                    await asyncio.sleep(delay)
+                elif self.session_start_limit.remaining < self.session_start_limit.total // 10:
+                    logging.warning(f'only {self.session_start_limit.remaining} session starts remaining')
+        except BaseException:
+            lock.release()
+            raise
+
+    def release(self, shard_id: int):
+        # the bucket is held for the full window after the identify went out
+        asyncio.get_event_loop().call_later(self.per, self._lock(shard_id).release)
 
 
 class DiscordWebSocket:
@@ -107,44 +286,72 @@ class DiscordWebSocket:
     HELLO = 10
     HEARTBEAT_ACK = 11
 
+    # close codes no reconnect can fix: authentication failed, invalid shard, sharding required,
+    # invalid api version, invalid or disallowed intents
+    FATAL_CLOSE_CODES = (4004, 4010, 4011, 4012, 4013, 4014)
+
     client: 'Client' = None
     socket: ClientWebSocketResponse = None
     token = None
-    _zlib = zlib.decompressobj()
-    _buffer = bytearray()
     sequence = None
     session_id = None
     _close_code = None
 
-    def __init__(self, client):
+    def __init__(self, client, shard_id: int = 0, shard_count: int = 1):
         self.client = client
+        self.shard_id: int = shard_id
+        self.shard_count: int = shard_count
         self._rate_limiter = GatewayRateLimiter()
-        self.heartbeat_manager: HeartbeatThread = None
+        self.heartbeat_manager: Optional[HeartbeatManager] = None
+        self.latency_histogram: LatencyHistogram = LatencyHistogram()
         self.loop = client.loop
         self.gateway_url = None
+        self.encoding: str = client.gateway_encoding
+        self.decompressor: Optional[TransportDecompressor] = get_decompressor(client.transport_compression)
+        self.dispatcher: BaseEventDispatcher = client.event_dispatcher_factory()
+        self.dispatcher.start(client)
+        self.chunk_scheduler: MemberChunkScheduler = MemberChunkScheduler(self, client.member_chunk_rate)
+        self.member_lookup: MemberLookupBatcher = MemberLookupBatcher(self)
+        # number of dispatch frames dropped by selective dispatch
+        self.skipped_events: int = 0
+        # the session was restored from a previous process, its guilds never came with a READY
+        self.restored_session: bool = False
         pass
 
-    async def send_as_json(self, payload: dict, ignore_rate_limit: bool = False):
-        if not ignore_rate_limit:
-            await self._rate_limiter.block()
+    async def send_as_json(self, payload: dict, priority: int = GatewayRateLimiter.DEFAULT):
+        await self._rate_limiter.block(priority)
         try:
-            await self.socket.send_json(payload)
+            if self.encoding == 'etf':
+                await self.socket.send_bytes(etf.encode(payload))
+            else:
+                await self.socket.send_str(utils.get_json_from_dict(payload))
         except RuntimeError as e:
             if not self._can_handle_close():
                 raise ConnectionClosed(self.socket) from e
 
     async def handle_message(self, data):
-        if type(data) is bytes:
-            self._buffer.extend(data)
-            # zlib stream not finished
-            if len(data) < 4 or data[-4:] != b'\x00\x00\xff\xff':
+        if type(data) is bytes and self.decompressor is not None:
+            # the json codec reads the bytes directly, no need to decode them first
+            data = self.decompressor.decompress(data)
+            if data is None:
                 return
-            # data stream complete -> decompress
-            data = self._zlib.decompress(self._buffer)
-            data = data.decode('utf-8')
-            # clear buffer
-            self._buffer = bytearray()
-        msg = utils.get_dict_from_json(data)
+        if self.client.selective_dispatch and self.encoding == 'json':
+            # peek at the header of dispatch frames and drop events nobody listens to without decoding them
+            if type(data) is bytes:
+                header = DISPATCH_HEADER.match(data)
+                event = header.group(1).decode('ascii') if header is not None else None
+            else:
+                header = DISPATCH_HEADER_STR.match(data)
+                event = header.group(1) if header is not None else None
+            if header is not None and not self.client.wants_gateway_event(event):
+                seq = int(header.group(2))
+                if self.sequence is None or seq > self.sequence:
+                    self.sequence = seq
+                if self.heartbeat_manager:
+                    self.heartbeat_manager.tick()
+                self.skipped_events += 1
+                return
+        msg = etf.decode(data) if self.encoding == 'etf' else utils.get_dict_from_json(data)
 
         op = msg.get('op')
         seq = msg.get('s')
@@ -158,11 +365,17 @@ class DiscordWebSocket:
             self.heartbeat_manager.tick()
 
         if op == self.HELLO:
-            self.heartbeat_manager = HeartbeatThread(self, data.get('heartbeat_interval') / 1000.0)
-            logging.debug('received hello, send heartbeat')
-            await self.send_as_json(self.heartbeat_manager.get_payload())
+            if self.heartbeat_manager:
+                self.heartbeat_manager.stop()
+            self.heartbeat_manager = HeartbeatManager(self, data.get('heartbeat_interval') / 1000.0)
+            logging.debug('received hello, start heartbeat')
             self.heartbeat_manager.start()
             return
+        if op == self.HEARTBEAT:
+            # the gateway wants a heartbeat right now
+            if self.heartbeat_manager:
+                await self.send_heartbeat()
+            return
         if op == self.HEARTBEAT_ACK:
             if self.heartbeat_manager:
                 self.heartbeat_manager.ack()
@@ -178,15 +391,29 @@ class DiscordWebSocket:
                 self.sequence = msg.get('s')
                 self.session_id = data.get('session_id')
                 self.gateway_url = data.get('resume_gateway_url')
-                self.client._guilds = {}
+                self.restored_session = False
+                self.chunk_scheduler.reset()
+                self.member_lookup.reset()
+                # forget the guilds of this shard, the other shards keep theirs
+                for gid in [g for g in self.client._guilds if (g >> 22) % self.shard_count == self.shard_id]:
+                    self.client._guilds.pop(gid, None)
                 for guild in data['guilds']:
                     self.client._guilds[int(guild.get('id'))] = None
-                logging.info(f'Connected to Gateway: {", ".join(data.get("_trace", []))} (Session ID: {self.session_id})')
+                logging.info(f'Connected to Gateway: {", ".join(data.get("_trace", []))} '
+                             f'(Shard: {self.shard_id}, Session ID: {self.session_id})')
             elif event == 'RESUMED':
                 logging.info(f'fully resumed session {self.session_id}')
+                # a member request sent right before the connection dropped may never have reached discord
+                self.chunk_scheduler.reset()
+                if self.restored_session:
+                    self.loop.create_task(self.client._on_shard_resumed(self.shard_id))
             else:
                 logging.debug(f'got event: {event} (data: {str(data)})')
-            self.loop.create_task(self.client.dispatch_gateway_event(event, data))
+            if event == 'GUILD_MEMBERS_CHUNK':
+                # resolved before the dispatcher, the handler waiting for a lookup may block the lane this chunk
+                # would be queued in with ordered dispatchers
+                self.member_lookup.chunk_received(data)
+            await self.dispatcher.submit(event, data)
             return
         if op == self.INVALID_SESSION:
             if data is True:
@@ -204,18 +431,44 @@ class DiscordWebSocket:
             self.heartbeat_manager.stop()
             self.heartbeat_manager = None
         self._close_code = code
-        await self.socket.close(code=code)
+        if self.socket is not None:
+            await self.socket.close(code=code)
+
+    @property
+    def latency(self) -> float:
+        """latency of the latest heartbeat in seconds"""
+        return self.latency_histogram.last
+
+    def get_session(self) -> dict:
+        """Returns the state needed to resume the current session"""
+        return {
+            'session_id': self.session_id,
+            'sequence': self.sequence,
+            'gateway_url': self.gateway_url
+        }
+
+    def restore_session(self, state: Optional[dict]) -> bool:
+        """Restores a state returned by get_session, returns True if the session can be resumed"""
+        if state is None or state.get('session_id') is None:
+            return False
+        self.session_id = state['session_id']
+        self.sequence = state.get('sequence')
+        self.gateway_url = state.get('gateway_url')
+        self.restored_session = True
+        return True
 
     async def send_heartbeat(self):
-        await self.send_as_json(self.heartbeat_manager.get_payload(), ignore_rate_limit=True)
+        await self.send_as_json(self.heartbeat_manager.get_payload(), GatewayRateLimiter.HEARTBEAT)
 
     def _can_handle_close(self):
-        return self.socket.close_code not in (1000, 4004, 4010, 4011, 4012, 4013, 4014)
+        return self.socket.close_code != 1000 and self.socket.close_code not in self.FATAL_CLOSE_CODES
 
     async def poll_event(self):
         try:
             msg = await self.socket.receive()
             if msg.type in (aiohttp.WSMsgType.TEXT, aiohttp.WSMsgType.BINARY):
+                if self.client.gateway_recorder is not None:
+                    self.client.gateway_recorder.record(self.shard_id, msg.data)
                 await self.handle_message(msg.data)
             elif msg.type is aiohttp.WSMsgType.ERROR:
                 logging.error(f'received error {str(msg)}')
@@ -244,14 +497,15 @@ class DiscordWebSocket:
 
         pass
 
-    async def identify(self, priority=False):
+    async def identify(self):
         d = {
             'op': self.IDENTIFY,
             'd': {
                 'token': self.token,
-                'compress': True,
+                # payload compression is only understood in combination with transport compression
+                'compress': self.decompressor is not None,
                 'large_threshold': 250,
-                'shard': [self.client.shard_id, self.client.shard_count],
+                'shard': [self.shard_id, self.shard_count],
                 'intents': self.client.intents.value,
                 'properties': {
                     'os': platform(),
@@ -265,7 +519,7 @@ class DiscordWebSocket:
         }
         if self.client.activity is not None:
             d['d']['presence']['activities'] = [self.client.activity]
-        await self.send_as_json(d, ignore_rate_limit=priority)
+        await self.send_as_json(d, GatewayRateLimiter.IDENTIFY)
 
     async def update_presence(self):
         d = {
@@ -276,19 +530,24 @@ class DiscordWebSocket:
         }
         if self.client.activity is not None:
             d['d']['activities'] = [self.client.activity]
-        await self.send_as_json(d)
+        await self.send_as_json(d, GatewayRateLimiter.PRESENCE)
 
-    async def request_guild_members(self, gid: int):
+    async def request_guild_members(self, gid: int, nonce: Optional[str] = None, user_ids: Optional[List[int]] = None):
         d = {
             'op': self.REQUEST_GUILD_MEMBERS,
             'd': {
                 'guild_id': gid,
-                'limit': 0,
-                'query': '',
                 'presences': False
             }
         }
-        await self.send_as_json(d)
+        if user_ids is not None:
+            d['d']['user_ids'] = user_ids
+        else:
+            d['d']['limit'] = 0
+            d['d']['query'] = ''
+        if nonce is not None:
+            d['d']['nonce'] = nonce
+        await self.send_as_json(d, GatewayRateLimiter.REQUEST_MEMBERS)
 
     async def resume(self):
         d = {
@@ -299,26 +558,63 @@ class DiscordWebSocket:
                 'seq': self.sequence
             }
         }
-        await self.send_as_json(d)
+        await self.send_as_json(d, GatewayRateLimiter.RESUME)
 
     async def run(self, resume=False):
         self._close_code = None
-        self._zlib = zlib.decompressobj()
-        self._buffer = bytearray()
-        gateway = await self.client.http.get_gateway(resume, self.gateway_url)
+        if self.decompressor is not None:
+            self.decompressor.reset()
+        gateway = await self.client.http.get_gateway(resume, self.gateway_url, encoding=self.encoding,
+                                                     compress=self.decompressor.name if self.decompressor is not None else None)
         logging.debug(f'connecting to gateway {gateway}')
         self.socket = await self.client.http.ws_connect(gateway)
         self.token = self.client.http.token
+        if self.client.gateway_recorder is not None:
+            self.client.gateway_recorder.record_connect(self)
 
         # wait for HELLO
         await self.poll_event()
 
+        poll = None
         if not resume:
-            await self.identify(True)
+            self.client._new_session(self.shard_id)
+            poll = await self._wait_for_identify_slot()
+            try:
+                await self.identify()
+            finally:
+                self.client.identify_limiter.release(self.shard_id)
         else:
             await self.resume()
+        if poll is not None:
+            await poll
         # actually run stuff 🎉
         while True:
             await self.poll_event()
 
+    async def _wait_for_identify_slot(self) -> Optional[asyncio.Task]:
+        """Waits for the identify slot of this shard while still reading the socket, so heartbeat acks are not
+        missed during a long wait. Returns the read that is still running once the slot was granted."""
+        slot = self.loop.create_task(self.client.identify_limiter.block(self.shard_id))
+        poll = None
+        try:
+            while not slot.done():
+                if poll is None:
+                    poll = self.loop.create_task(self.poll_event())
+                await asyncio.wait([slot, poll], return_when=asyncio.FIRST_COMPLETED)
+                if poll.done():
+                    # raises if the connection went away while we waited
+                    poll.result()
+                    poll = None
+            slot.result()
+        except BaseException:
+            if poll is not None:
+                poll.cancel()
+            if not slot.done():
+                slot.cancel()
+            elif not slot.cancelled() and slot.exception() is None:
+                # got the slot but will not identify on this connection
+                self.client.identify_limiter.release(self.shard_id)
+            raise
+        return poll
+
 
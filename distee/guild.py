@@ -288,12 +288,12 @@ class Guild(Snowflake):
     async def handle_channel_delete(self, data: dict):
         self._channels.pop(int(data['id']), None)
 
-    async def handle_member_chunk(self, data: dict):
+    async def handle_member_chunk(self, data: dict, quiet: bool = False):
         for m_data in data['members']:
             m = Member(**m_data, _client=self._client, _guild=self)
             await self._client.member_cache.member_added(m)
 
-        if data['chunk_index'] == (data['chunk_count'] - 1):
+        if not quiet and data['chunk_index'] == (data['chunk_count'] - 1):
             logging.info(f'filled member cache for guild {self.id}: got {len(await self._client.member_cache.get_guild_members(self.id))} members')
 
     def handle_guild_update(self, **kwargs):
@@ -366,11 +366,16 @@ class Guild(Snowflake):
         return member
 
     async def obtain_member(self, member_id: Union[Snowflake, int]) -> Member:
-        """Either get from cache or fetch if not in cache"""
+        """Either get from cache, look up over the gateway or fetch if neither worked"""
         m = await self.get_member(member_id)
-        if m is None:
-            return await self.fetch_member(member_id)
-        return m
+        if m is not None:
+            return m
+        ws = self._client._get_websocket(self.id)
+        if ws is not None:
+            data = await ws.member_lookup.lookup(self.id, snowflake_id(member_id))
+            if data is not None:
+                return Member(**data, _client=self._client, _guild=self)
+        return await self.fetch_member(member_id)
 
     def get_role(self, role_id: Union[Snowflake, int]) -> Optional[Role]:
         return self.roles.get(role_id.id if isinstance(role_id, Snowflake) else role_id)
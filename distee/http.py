@@ -1,5 +1,4 @@
 import asyncio
-import json
 import typing
 from typing import Optional, Iterable, Dict, Any, List, Union
 
@@ -10,6 +9,8 @@ from .errors import HTTPException, GatewayNotFound, Forbidden, NotFound, Discord
 import logging
 from .message import Message
 from .route import Route
+from .ratelimit import RESTRateLimiter, GlobalRateLimiter
+from .payload import MessagePayload, message_payload
 from .channel import get_channel
 
 if typing.TYPE_CHECKING:
@@ -20,28 +21,11 @@ if typing.TYPE_CHECKING:
 
 
 async def get_json_or_str(response: ClientResponse):
-    text = await response.text(encoding='utf-8')
+    body = await response.read()
     ct = response.headers.get('content-type')
     if ct is not None and ct == 'application/json':
-        return json.loads(text)
-    return text
-
-
-class MaybeUnlock:
-
-    def __init__(self, lock):
-        self.lock = lock
-        self._unlock = True
-
-    def __enter__(self):
-        return self
-
-    def defer(self):
-        self._unlock = False
-
-    def __exit__(self, exc_type, exc_val, exc_tb):
-        if self._unlock:
-            self.lock.release()
+        return utils.get_dict_from_json(body)
+    return body.decode('utf-8')
 
 
 class HTTPClient:
@@ -54,17 +38,52 @@ class HTTPClient:
         self.user_agent = 'DiscordBot (https://github.com/Teekeks/DisTee.py v{version})'.format(version=utils.VERSION)
         self.__session: Optional[ClientSession] = None
         self.token: Optional[str] = None
-        self._locks = {}
-        self._global_lock_over = asyncio.Event()
-        self._global_lock_over.set()
+        # fixed gateway url, skips asking the REST api for it (e.g. to connect to a FakeGateway)
+        self.gateway_url: Optional[str] = None
+        self.rate_limiter: RESTRateLimiter = RESTRateLimiter()
+        # lower its rate if the bot shares the global limit with other processes, raise it for large bots
+        self.global_rate_limiter: GlobalRateLimiter = GlobalRateLimiter()
+        # connection pool of the REST session, used when do_login creates it
+        self.connection_limit: int = 100
+        # 0 for no limit besides connection_limit, almost every request goes to discord.com anyway
+        self.connection_limit_per_host: int = 0
+        # seconds an idle connection is kept open for the next request
+        self.keepalive_timeout: float = 15.0
+        # seconds resolved addresses are cached, None caches them forever
+        self.dns_cache_ttl: Optional[int] = 300
+        # connections opened right after login, so the first interaction responses skip the TLS handshake
+        self.warm_up_connections: int = 0
 
     async def close(self):
         if self.__session:
             await self.__session.close()
 
+    def make_connector(self) -> aiohttp.TCPConnector:
+        # aiohttp sets TCP_NODELAY on every connection by itself
+        return aiohttp.TCPConnector(limit=self.connection_limit,
+                                    limit_per_host=self.connection_limit_per_host,
+                                    keepalive_timeout=self.keepalive_timeout,
+                                    ttl_dns_cache=self.dns_cache_ttl)
+
+    async def warm_up(self, connections: int):
+        """Opens the given number of connections to the api, they stay in the pool for keepalive_timeout"""
+        async def _open():
+            # unauthenticated, does not count against the rate limits of the bot
+            async with self.__session.get(Route.BASE_URL + '/gateway') as r:
+                await r.read()
+
+        results = await asyncio.gather(*(_open() for _ in range(connections)), return_exceptions=True)
+        failed = [r for r in results if isinstance(r, Exception)]
+        if failed:
+            logging.warning(f'could not open {len(failed)} of {connections} connections: {failed[0]!r}')
+        else:
+            logging.debug(f'opened {connections} connections to the api')
+
     async def do_login(self, token: str):
-        self.__session = ClientSession()
+        self.__session = ClientSession(connector=self.make_connector())
         self.token = token
+        if self.warm_up_connections > 0:
+            await self.warm_up(self.warm_up_connections)
         try:
             data = await self.request(Route('GET', '/users/@me'))
         except HTTPException:
@@ -73,20 +92,33 @@ class HTTPClient:
         return data
     pass
 
-    async def get_gateway(self, resume: bool, resume_gateway: str = None, encoding: str = 'json', zlib: bool = True) -> str:
+    async def get_gateway(self,
+                          resume: bool,
+                          resume_gateway: str = None,
+                          encoding: str = 'json',
+                          compress: Optional[str] = 'zlib-stream') -> str:
         if resume and resume_gateway is not None:
             url = resume_gateway
+        elif self.gateway_url is not None:
+            url = self.gateway_url
         else:
             try:
                 data = await self.request(Route('GET', '/gateway'))
                 url = data['url']
             except HTTPException as ex:
                 raise GatewayNotFound from ex
-        if zlib:
-            return f'{url}?encoding={encoding}&v={utils.GATEWAY_VERSION}&compress=zlib-stream'
+        if compress is not None:
+            return f'{url}?encoding={encoding}&v={utils.GATEWAY_VERSION}&compress={compress}'
         else:
             return f'{url}?encoding={encoding}&v={utils.GATEWAY_VERSION}'
 
+    async def get_bot_gateway(self) -> dict:
+        """Fetches the gateway url, recommended shard count and session start limit of this bot"""
+        try:
+            return await self.request(Route('GET', '/gateway/bot'))
+        except HTTPException as ex:
+            raise GatewayNotFound from ex
+
     async def ws_connect(self, url: str):
         return await self.__session.ws_connect(url, timeout=30)
 
@@ -103,22 +135,15 @@ class HTTPClient:
                            stickers: Optional[List] = None,
                            components: Optional[List[Union[dict, 'BaseComponent']]] = None,
                            flags: Optional[int] = None) -> 'Message':
-        payload = {'tts': tts}
-        form = []
-        if content is not None:
-            payload['content'] = content
-        if message_reference is not None:
-            payload['message_reference'] = message_reference
-        if embeds is not None:
-            payload['embeds'] = embeds
-        if components is not None:
-            payload['components'] = utils.get_components(components)
-        if allowed_mentions is not None:
-            payload['allowed_mentions'] = allowed_mentions
-        form.append({'name': 'payload_json', 'value': json.dumps(payload)})
-        data = await self.request(route, form=form)
+        payload = MessagePayload(message_payload(content=content,
+                                                 tts=tts,
+                                                 embeds=embeds,
+                                                 allowed_mentions=allowed_mentions,
+                                                 message_reference=message_reference,
+                                                 components=components,
+                                                 files=files), files)
+        data = await self.request(route, payload=payload)
         return Message(**data, _client=self.client)
-    pass
 
     async def send_message(self,
                            route: Route,
@@ -133,90 +158,22 @@ class HTTPClient:
                            stickers: Optional[List] = None,
                            components: Optional[List[Union[dict, 'BaseComponent']]] = None,
                            flags: Optional[int] = None) -> 'Message':
-        if files is not None:
-            return await self.send_multipart(route,
-                                             files=files,
-                                             content=content,
-                                             tts=tts,
-                                             embeds=embeds,
-                                             nonce=nonce,
-                                             allowed_mentions=allowed_mentions,
-                                             message_reference=message_reference,
-                                             stickers=stickers,
-                                             components=components,
-                                             flags=flags)
-
-        payload = {'tts': tts}
-        form = []
-        if content is not None:
-            payload['content'] = content
-        if message_reference is not None:
-            payload['message_reference'] = message_reference
-        if embeds is not None:
-            payload['embeds'] = embeds
-        if components is not None:
-            payload['components'] = utils.get_components(components)
-        if allowed_mentions is not None:
-            payload['allowed_mentions'] = allowed_mentions
-        if nonce is not None:
-            payload['nonce'] = nonce
-        if stickers is not None:
-            payload['sticker_ids'] = stickers
-        if flags is not None:
-            payload['flags'] = flags
-        form.append({'name': 'payload_json', 'value': json.dumps(payload)})
-        d = await self.request(route, form=form)
+        payload = MessagePayload(message_payload(content=content,
+                                                 tts=tts,
+                                                 embeds=embeds,
+                                                 nonce=nonce,
+                                                 allowed_mentions=allowed_mentions,
+                                                 message_reference=message_reference,
+                                                 stickers=stickers,
+                                                 components=components,
+                                                 flags=flags,
+                                                 files=files), files)
+        d = await self.request(route, payload=payload)
         return Message(**d, _client=self.client)
 
-    async def send_multipart(self,
-                             route: Route,
-                             *,
-                             files: List['File'] = None,
-                             content: Optional[str] = None,
-                             tts: bool = False,
-                             embeds: Optional[Dict] = None,
-                             nonce: Optional[str] = None,
-                             allowed_mentions: Optional[Dict] = None,
-                             message_reference: Optional[Dict] = None,
-                             stickers: Optional[List] = None,
-                             components: Optional[List[Union[dict, 'BaseComponent']]] = None,
-                             flags: Optional[int] = None) -> 'Message':
-        payload = {'tts': tts}
-        form = []
-        if content is not None:
-            payload['content'] = content
-        if message_reference is not None:
-            payload['message_reference'] = message_reference
-        if embeds is not None:
-            payload['embeds'] = embeds
-        if components is not None:
-            payload['components'] = utils.get_components(components)
-        if allowed_mentions is not None:
-            payload['allowed_mentions'] = allowed_mentions
-        if nonce is not None:
-            payload['nonce'] = nonce
-        if stickers is not None:
-            payload['sticker_ids'] = stickers
-        if flags is not None:
-            payload['flags'] = flags
-        if files is not None:
-            if len(files) == 1:
-                payload['attachments'] = [{
-                    'id': 0,
-                    'description': files[0].description
-                }]
-        form.append({'name': 'payload_json', 'value': json.dumps(payload)})
-        if len(files) == 1:
-            file = files[0]
-            form.append({
-                'name': 'files[0]',
-                'value': file.fp,
-                'filename': file.filename,
-                'content_type': 'application/octet-stream',
-                'content_transfer_encoding': 'binary'
-            })
-        d = await self.request(route, form=form, files=files)
-        return Message(**d, _client=self.client)
+    async def send_multipart(self, route: Route, **kwargs) -> 'Message':
+        """send_message picks multipart by itself if files are attached"""
+        return await self.send_message(route, **kwargs)
 
     async def create_thread(self,
                             route: Route,
@@ -234,42 +191,17 @@ class HTTPClient:
                             stickers: Optional[List] = None,
                             components: Optional[List[Union[dict, 'BaseComponent']]] = None,
                             flags: Optional[int] = None) -> ('Thread', 'Message'):
-        if files is not None:
-            return await self.create_thread_multipart(route,
-                                                      name=name,
-                                                      auto_archive_duration=auto_archive_duration,
-                                                      rate_limit_per_user=rate_limit_per_user,
-                                                      applied_tags=applied_tags,
-                                                      files=files,
-                                                      content=content,
-                                                      embeds=embeds,
-                                                      nonce=nonce,
-                                                      allowed_mentions=allowed_mentions,
-                                                      message_reference=message_reference,
-                                                      stickers=stickers,
-                                                      components=components,
-                                                      flags=flags)
-
-        message_payload = {}
-        if content is not None:
-            message_payload['content'] = content
-        if message_reference is not None:
-            message_payload['message_reference'] = message_reference
-        if embeds is not None:
-            message_payload['embeds'] = embeds
-        if components is not None:
-            message_payload['components'] = utils.get_components(components)
-        if allowed_mentions is not None:
-            message_payload['allowed_mentions'] = allowed_mentions
-        if nonce is not None:
-            message_payload['nonce'] = nonce
-        if stickers is not None:
-            message_payload['sticker_ids'] = stickers
-        if flags is not None:
-            message_payload['flags'] = flags
         payload = {
             'name': name,
-            'message': message_payload
+            'message': message_payload(content=content,
+                                       embeds=embeds,
+                                       nonce=nonce,
+                                       allowed_mentions=allowed_mentions,
+                                       message_reference=message_reference,
+                                       stickers=stickers,
+                                       components=components,
+                                       flags=flags,
+                                       files=files)
         }
         if auto_archive_duration is not None:
             payload['auto_archive_duration'] = auto_archive_duration
@@ -277,80 +209,27 @@ class HTTPClient:
             payload['rate_limit_per_user'] = rate_limit_per_user
         if applied_tags is not None:
             payload['applied_tags'] = applied_tags
-        d = await self.request(route, json=payload)
+        d = await self.request(route, payload=MessagePayload(payload, files))
         thread = get_channel(**d, _client=self.client)
         message = Message(**d['message'], _client=self.client)
         return thread, message
 
-    async def create_thread_multipart(self,
-                                      route: Route,
-                                      *,
-                                      name: str,
-                                      auto_archive_duration: Optional[int] = None,
-                                      rate_limit_per_user: Optional[int] = None,
-                                      applied_tags: Optional[List[int]] = None,
-                                      files: List['File'] = None,
-                                      content: Optional[str] = None,
-                                      embeds: Optional[Dict] = None,
-                                      nonce: Optional[str] = None,
-                                      allowed_mentions: Optional[Dict] = None,
-                                      message_reference: Optional[Dict] = None,
-                                      stickers: Optional[List] = None,
-                                      components: Optional[List[Union[dict, 'BaseComponent']]] = None,
-                                      flags: Optional[int] = None) -> 'Thread':
-        payload = {}
-        form = []
-        if content is not None:
-            payload['content'] = content
-        if message_reference is not None:
-            payload['message_reference'] = message_reference
-        if embeds is not None:
-            payload['embeds'] = embeds
-        if components is not None:
-            payload['components'] = utils.get_components(components)
-        if allowed_mentions is not None:
-            payload['allowed_mentions'] = allowed_mentions
-        if nonce is not None:
-            payload['nonce'] = nonce
-        if stickers is not None:
-            payload['sticker_ids'] = stickers
-        if flags is not None:
-            payload['flags'] = flags
-        if files is not None:
-            if len(files) == 1:
-                payload['attachments'] = [{
-                    'id': 0,
-                    'description': files[0].description
-                }]
-        form.append({'name': 'payload_json', 'value': json.dumps(payload)})
-        if len(files) == 1:
-            file = files[0]
-            form.append({
-                'name': 'files[0]',
-                'value': file.fp,
-                'filename': file.filename,
-                'content_type': 'application/octet-stream',
-                'content_transfer_encoding': 'binary'
-            })
-        d = await self.request(route, form=form, files=files)
-        return get_channel(**d, _client=self.client)
+    async def create_thread_multipart(self, route: Route, **kwargs) -> 'Thread':
+        """create_thread picks multipart by itself if files are attached"""
+        thread, _ = await self.create_thread(route, **kwargs)
+        return thread
 
     async def request(self,
                       route: Route,
                       form: Optional[Iterable[Dict[str, Any]]] = None,
                       files: Optional[Iterable['File']] = None,
+                      payload: Optional[MessagePayload] = None,
                       **kwargs):
         if self.request_listener is not None:
             asyncio.ensure_future(self.request_listener(route))
         method = route.method
-        bucket = route.bucket
         url = route.url
 
-        lock = self._locks.get(bucket)
-        if lock is None:
-            lock = asyncio.Lock()
-            self._locks[bucket] = lock
-
         headers = {
             'User-Agent': self.user_agent,
             'X-RateLimit-Precision': 'millisecond',
@@ -365,80 +244,77 @@ class HTTPClient:
 
         if 'json' in kwargs:
             headers['Content-Type'] = 'application/json'
-            kwargs['data'] = json.dumps(kwargs.pop('json'))
-
-        # wait for a global api lock to be over :(
-        if not self._global_lock_over.is_set():
-            await self._global_lock_over.wait()
-
-        await lock.acquire()
-        with MaybeUnlock(lock) as maybe_unlock:
-            for tries in range(5):
-                try:
-                    if files is not None:
-                        for f in files:
-                            f.reset(seek=tries)
-
-                    if form is not None:
-                        form_data = aiohttp.FormData(quote_fields=False)
-                        for p in form:
-                            form_data.add_field(**p)
-                        kwargs['data'] = form_data
-
-                    async with self.__session.request(method=method, url=url, **kwargs) as r:
-                        logging.debug(f'{method} {url} with {str(kwargs.get("data"))} has returned {r.status}')
-                        data = await get_json_or_str(r)
-
-                        remaining = r.headers.get('X-Ratelimit-Remaining')
-
-                        if remaining == '0' and r.status != 429:
-                            # bucket depleted :(
-                            delta = float(r.headers.get('X-Ratelimit-Reset-After'))
-                            logging.debug(f'A rate limit bucket has been exhausted (bucket: {bucket}, retry: {delta})')
-                            maybe_unlock.defer()
-                            self.loop.call_later(delta, lock.release)
-
-                        if 300 > r.status >= 200:
-                            return data
-
-                        if r.status == 429:
-                            if not r.headers.get('Via'):
-                                # this is cloudflare :(
-                                raise HTTPException(r, data)
-
-                            retry_after = float(data['retry_after'])
-                            logging.warning(f'We are being rate limited. Retrying in {retry_after:.2f} seconds. Bucket: {bucket}')
-                            is_global = data.get('global', False)
-                            if is_global:
-                                logging.warning(f'Global rate limit has been hit. Retrying in {retry_after:.2f} seconds.')
-                                self._global_lock_over.clear()
-                            await asyncio.sleep(retry_after)
-                            logging.debug(f'Done waiting for rate limit, retrying now...')
-                            if is_global:
-                                self._global_lock_over.set()
-                                logging.debug('Global rate limit is over!')
-                            continue
-
-                        # server error -> retry
-                        if r.status in (500, 502):
-                            await asyncio.sleep(1 + tries * 2)
-                            continue
-
-                        if r.status == 403:
-                            raise Forbidden(r, data)
-
-                        if r.status == 404:
-                            raise NotFound(r, data)
-
-                        if r.status == 503:
-                            raise DiscordServerError(r, data)
-                        else:
+            kwargs['data'] = utils.get_json_bytes_from_dict(kwargs.pop('json'))
+        elif payload is not None and payload.content_type is not None:
+            headers['Content-Type'] = payload.content_type
+
+        priority = GlobalRateLimiter.INTERACTION if route.interaction else GlobalRateLimiter.DEFAULT
+        for tries in range(5):
+            bucket = await self.rate_limiter.acquire(route)
+            try:
+                # only take from the global budget once the bucket lets us through, waiting there would waste it
+                await self.global_rate_limiter.block(priority)
+                if files is not None:
+                    for f in files:
+                        f.reset(seek=tries)
+
+                if form is not None:
+                    form_data = aiohttp.FormData(quote_fields=False)
+                    for p in form:
+                        form_data.add_field(**p)
+                    kwargs['data'] = form_data
+                elif payload is not None:
+                    kwargs['data'] = payload.body()
+
+                async with self.__session.request(method=method, url=url, **kwargs) as r:
+                    logging.debug(f'{method} {url} with {str(kwargs.get("data"))} has returned {r.status}')
+                    data = await get_json_or_str(r)
+
+                    if r.status != 429:
+                        self.rate_limiter.update(route, bucket, r.headers)
+
+                    if 300 > r.status >= 200:
+                        return data
+
+                    if r.status == 429:
+                        if not r.headers.get('Via'):
+                            # this is cloudflare :(
                             raise HTTPException(r, data)
-                except OSError as e:
-                    if tries < 4 and e.errno in (54, 10054):
+
+                        retry_after = float(data['retry_after'])
+                        logging.warning(f'We are being rate limited. Retrying in {retry_after:.2f} seconds. Bucket: {bucket.key}')
+                        is_global = data.get('global', False)
+                        if is_global:
+                            logging.warning(f'Global rate limit has been hit. Retrying in {retry_after:.2f} seconds.')
+                            # the retry waits in the global rate limiter, together with everyone else
+                            self.global_rate_limiter.rate_limited(retry_after)
+                        else:
+                            # the next acquire waits till the bucket resets
+                            bucket.rate_limited(retry_after)
+                        continue
+
+                    # server error -> retry
+                    if r.status in (500, 502):
+                        await asyncio.sleep(1 + tries * 2)
                         continue
-                    raise
 
-            if r.status >= 500:
-                raise DiscordServerError(r, data)
-            raise HTTPException(r, data)
+                    if r.status == 403:
+                        raise Forbidden(r, data)
+
+                    if r.status == 404:
+                        raise NotFound(r, data)
+
+                    if r.status == 503:
+                        raise DiscordServerError(r, data)
+                    else:
+                        raise HTTPException(r, data)
+            except OSError as e:
+                if tries < 4 and e.errno in (54, 10054):
+                    continue
+                raise
+            finally:
+                bucket.release()
+
+        if r.status >= 500:
+            raise DiscordServerError(r, data)
+        raise HTTPException(r, data)
@@ -4,7 +4,7 @@ from .application_command import ApplicationCommandOptionChoice
 from .attachment import Attachment
 from .components import Modal
 from .errors import WrongInteractionTypeException
-from .route import Route
+from .route import RouteTemplate
 from .utils import Snowflake, snowflake_or_none, get_json_from_dict, get_components
 from .enums import InteractionType, ApplicationCommandType, InteractionResponseType, ComponentType, InteractionContextType
 from .flags import InteractionCallbackFlags
@@ -19,6 +19,10 @@ if typing.TYPE_CHECKING:
     from .file import File
     from .components import BaseComponent
 
+INTERACTION_CALLBACK = RouteTemplate('POST', '/interactions/{interaction_id}/{interaction_token}/callback')
+FOLLOWUP_MESSAGE = RouteTemplate('POST', '/webhooks/{application_id}/{interaction_token}')
+ORIGINAL_MESSAGE = RouteTemplate('PATCH', '/webhooks/{application_id}/{interaction_token}/messages/@original')
+
 
 def get_parsed_modal_components(data) -> Optional[dict]:
     d = {}
@@ -97,10 +101,7 @@ class Interaction(Snowflake):
         """ACK component interaction now and edit message later"""
         if self.type != InteractionType.MESSAGE_COMPONENT:
             raise WrongInteractionTypeException()
-        await self._client.http.request(Route('POST',
-                                              '/interactions/{interaction_id}/{interaction_token}/callback',
-                                              interaction_id=self.id,
-                                              interaction_token=self.token),
+        await self._client.http.request(INTERACTION_CALLBACK(self.id, self.token),
                                         json={'type': InteractionResponseType.DEFERRED_UPDATE_MESSAGE.value, 'data': {}})
 
     async def update_message(self,
@@ -122,10 +123,7 @@ class Interaction(Snowflake):
                         'embeds': embeds,
                         'allowed_mentions': allowed_mentions
                     }.items() if v is not None}}
-        await self._client.http.request(Route('POST',
-                                              '/interactions/{interaction_id}/{interaction_token}/callback',
-                                              interaction_id=self.id,
-                                              interaction_token=self.token),
+        await self._client.http.request(INTERACTION_CALLBACK(self.id, self.token),
                                         json=json)
 
     async def send(self,
@@ -149,10 +147,7 @@ class Interaction(Snowflake):
                         'nonce': nonce,
                         'allowed_mentions': allowed_mentions
                     }.items() if v is not None}}
-        await self._client.http.request(Route('POST',
-                                              '/interactions/{interaction_id}/{interaction_token}/callback',
-                                              interaction_id=self.id,
-                                              interaction_token=self.token),
+        await self._client.http.request(INTERACTION_CALLBACK(self.id, self.token),
                                         json=json)
 
     async def premium_required(self):
@@ -160,10 +155,7 @@ class Interaction(Snowflake):
             'type': InteractionResponseType.PREMIUM_REQUIRED.value,
             'data': {}
         }
-        await self._client.http.request(Route('POST',
-                                              '/interactions/{interaction_id}/{interaction_token}/callback',
-                                              interaction_id=self.id,
-                                              interaction_token=self.token),
+        await self._client.http.request(INTERACTION_CALLBACK(self.id, self.token),
                                         json=json)
 
     async def send_followup(self,
@@ -177,10 +169,7 @@ class Interaction(Snowflake):
                             files: Optional['File'] = None,
                             ephemeral: Optional[bool] = None):
         """send a followup message after deferring it"""
-        return await self._client.http.send_message(Route('POST',
-                                                          '/webhooks/{application_id}/{interaction_token}',
-                                                          application_id=self.application_id,
-                                                          interaction_token=self.token),
+        return await self._client.http.send_message(FOLLOWUP_MESSAGE(self.application_id, self.token),
                                                     components=get_components(components),
                                                     content=content,
                                                     tts=tts,
@@ -202,10 +191,7 @@ class Interaction(Snowflake):
                             files: Optional['File'] = None,
                             ephemeral: Optional[bool] = None):
         """edit the original message of this interaction"""
-        return await self._client.http.send_message(Route('PATCH',
-                                                          '/webhooks/{application_id}/{interaction_token}/messages/@original',
-                                                          application_id=self.application_id,
-                                                          interaction_token=self.token),
+        return await self._client.http.send_message(ORIGINAL_MESSAGE(self.application_id, self.token),
                                                     components=get_components(components),
                                                     content=content,
                                                     tts=tts,
@@ -220,19 +206,13 @@ class Interaction(Snowflake):
         """ACK now and use send later"""
         json = {'type': InteractionResponseType.DEFERRED_CHANNEL_MESSAGE_WITH_SOURCE.value,
                 'data': {'flags': 1 << 6} if ephemeral else {}}
-        await self._client.http.request(Route('POST',
-                                              '/interactions/{interaction_id}/{interaction_token}/callback',
-                                              interaction_id=self.id,
-                                              interaction_token=self.token),
+        await self._client.http.request(INTERACTION_CALLBACK(self.id, self.token),
                                         json=json)
 
     async def send_modal(self, data: Union[Dict, Modal]):
         json = {'type': InteractionResponseType.MODAL.value,
                 'data': data if isinstance(data, dict) else data.to_json()}
-        await self._client.http.request(Route('POST',
-                                              '/interactions/{interaction_id}/{interaction_token}/callback',
-                                              interaction_id=self.id,
-                                              interaction_token=self.token),
+        await self._client.http.request(INTERACTION_CALLBACK(self.id, self.token),
                                         form=[{'name': 'payload_json', 'value': get_json_from_dict(json)}])
 
     async def autocomplete_options(self, choices: List[ApplicationCommandOptionChoice]):
@@ -242,8 +222,5 @@ class Interaction(Snowflake):
                 'choices': [c.to_json() for c in choices]
             }
         }
-        await self._client.http.request(Route('POST',
-                                              '/interactions/{interaction_id}/{interaction_token}/callback',
-                                              interaction_id=self.id,
-                                              interaction_token=self.token),
+        await self._client.http.request(INTERACTION_CALLBACK(self.id, self.token),
                                         json=json)
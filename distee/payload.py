@@ -0,0 +1,124 @@
+import asyncio
+import typing
+from typing import Optional, List, Dict, Union
+
+import aiohttp
+import aiohttp.payload
+
+from . import utils
+
+if typing.TYPE_CHECKING:
+    from .file import File
+    from .components import BaseComponent
+
+
+def message_payload(*,
+                    content: Optional[str] = None,
+                    tts: Optional[bool] = None,
+                    embeds: Optional[List[dict]] = None,
+                    nonce: Optional[str] = None,
+                    allowed_mentions: Optional[Dict] = None,
+                    message_reference: Optional[Dict] = None,
+                    stickers: Optional[List] = None,
+                    components: Optional[List[Union[dict, 'BaseComponent']]] = None,
+                    flags: Optional[int] = None,
+                    files: Optional[List['File']] = None) -> dict:
+    """Returns the json of a message, everything left at None is not sent"""
+    payload = {}
+    if tts is not None:
+        payload['tts'] = tts
+    if content is not None:
+        payload['content'] = content
+    if message_reference is not None:
+        payload['message_reference'] = message_reference
+    if embeds is not None:
+        payload['embeds'] = embeds
+    if components is not None:
+        payload['components'] = utils.get_components(components)
+    if allowed_mentions is not None:
+        payload['allowed_mentions'] = allowed_mentions
+    if nonce is not None:
+        payload['nonce'] = nonce
+    if stickers is not None:
+        payload['sticker_ids'] = stickers
+    if flags is not None:
+        payload['flags'] = flags
+    if files:
+        # ids refer to the files[n] parts of the multipart body
+        payload['attachments'] = [{'id': i, 'filename': f.filename, 'description': f.description}
+                                  for i, f in enumerate(files)]
+    return payload
+
+
+class FilePayload(aiohttp.payload.Payload):
+    """Streams a File into the request body chunk by chunk, the file is never read into memory as a whole
+    and stays open afterwards so a retry can send it again"""
+
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, file: 'File'):
+        super(FilePayload, self).__init__(file.fp, content_type='application/octet-stream')
+        self.file: 'File' = file
+
+    @property
+    def size(self) -> Optional[int]:
+        return self.file.size
+
+    async def write(self, writer):
+        view = self.file.view()
+        if view is not None:
+            # straight from the page cache, slicing a memoryview copies nothing
+            try:
+                for i in range(0, len(view), self.CHUNK_SIZE):
+                    await writer.write(view[i:i + self.CHUNK_SIZE])
+            finally:
+                view.release()
+            return
+        loop = asyncio.get_running_loop()
+        on_disk = self.file.on_disk
+        while True:
+            if on_disk:
+                chunk = await loop.run_in_executor(None, self.file.fp.read, self.CHUNK_SIZE)
+            else:
+                chunk = self.file.fp.read(self.CHUNK_SIZE)
+            if not chunk:
+                return
+            await writer.write(chunk)
+
+    def decode(self, encoding: str = 'utf-8', errors: str = 'strict') -> str:
+        return f'<file {self.file.filename}>'
+
+
+class MessagePayload:
+    """Body of a request that creates or edits a message.
+
+    The json is serialized once and reused by every retry, it is sent as is without files
+    and as the payload_json part of a multipart form with files."""
+
+    # attachments discord allows per message
+    MAX_FILES = 10
+
+    def __init__(self, data: dict, files: Optional[List['File']] = None):
+        if files is not None and len(files) > self.MAX_FILES:
+            raise ValueError(f'a message can have at most {self.MAX_FILES} files, got {len(files)}')
+        self.files: Optional[List['File']] = files if files else None
+        self.json: bytes = utils.get_json_bytes_from_dict(data)
+
+    @property
+    def content_type(self) -> Optional[str]:
+        """content type of the json body, multipart bodies set their own"""
+        return 'application/json' if self.files is None else None
+
+    def body(self) -> Union[bytes, aiohttp.MultipartWriter]:
+        """Returns the body for the next attempt of the request"""
+        if self.files is None:
+            return self.json
+        writer = aiohttp.MultipartWriter('form-data')
+        part = writer.append(self.json, {'Content-Type': 'application/json'})
+        part.set_content_disposition('form-data', name='payload_json')
+        for i, f in enumerate(self.files):
+            # rewinds what the previous attempt read, nothing is copied
+            f.reset()
+            part = writer.append_payload(FilePayload(f))
+            part.set_content_disposition('form-data', name=f'files[{i}]', filename=f.filename)
+        return writer
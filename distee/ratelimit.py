@@ -0,0 +1,354 @@
+import asyncio
+import heapq
+import logging
+import sys
+import time
+from collections import deque, OrderedDict
+from typing import Optional, Dict, Deque, List, Tuple
+
+from .route import Route
+
+
+class RateLimitBucket:
+    """Rate limit state of one discord bucket (or of a route whose bucket is not known yet).
+
+    Works like a semaphore sized by the remaining requests of the bucket: that many requests are let through
+    concurrently, everything else waits in a FIFO queue and gets woken up as soon as the bucket resets.
+    Till the first response told us the limit, only one request at a time is sent."""
+
+    __slots__ = ['key', 'limit', 'remaining', 'reset_at', 'window', 'unlimited', 'last_used',
+                 '_in_flight', '_waiters', '_timer']
+
+    def __init__(self, key: str):
+        self.key: str = key
+        self.limit: Optional[int] = None
+        self.remaining: Optional[int] = None
+        self.reset_at: float = 0.0
+        # longest reset_after seen, used to guess when a window we refilled ourselves ends
+        self.window: float = 0.0
+        # routes without rate limit headers
+        self.unlimited: bool = False
+        self.last_used: float = time.monotonic()
+        self._in_flight: int = 0
+        self._waiters: Deque[asyncio.Future] = deque()
+        self._timer: Optional[asyncio.TimerHandle] = None
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    @property
+    def queued(self) -> int:
+        """number of requests waiting for this bucket"""
+        return len(self._waiters)
+
+    def in_use(self, now: float) -> bool:
+        """A bucket in use can not be forgotten without risking a 429 or stranding its waiters"""
+        return self._in_flight > 0 or bool(self._waiters) or self._timer is not None \
+            or (self.remaining == 0 and now < self.reset_at)
+
+    def _take(self) -> bool:
+        """Takes one request of the bucket if possible"""
+        now = time.monotonic()
+        if self.remaining is not None and now >= self.reset_at:
+            # a new window started, refill once till a response tells us the real state.
+            # without a known limit (429 on the very first request) we are back to probing
+            self.remaining = self.limit
+            self.reset_at = now + self.window
+        if self.unlimited or (self.remaining is None and self._in_flight == 0):
+            pass
+        elif self.remaining is not None and self.remaining > 0:
+            self.remaining -= 1
+        else:
+            return False
+        self._in_flight += 1
+        return True
+
+    async def acquire(self) -> bool:
+        """Waits for a free request of this bucket.
+
+        Returns False if the route turned out to belong to a different bucket while waiting"""
+        if not self._waiters and self._take():
+            return True
+        fut = asyncio.get_event_loop().create_future()
+        self._waiters.append(fut)
+        self._schedule_reset()
+        try:
+            return await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled() and fut.result():
+                # we got a request granted but nobody is going to use it
+                self.release()
+            elif fut in self._waiters:
+                # still queued, futures resolved with False were already popped
+                self._waiters.remove(fut)
+            raise
+
+    def _on_reset(self):
+        self._timer = None
+        self._wake()
+
+    def _wake(self):
+        while self._waiters:
+            if self._waiters[0].done():
+                self._waiters.popleft()
+                continue
+            if not self._take():
+                break
+            self._waiters.popleft().set_result(True)
+        self._schedule_reset()
+
+    def _schedule_reset(self):
+        if self._waiters and self._timer is None and self.remaining is not None:
+            # exhausted, wake the queue exactly when the bucket resets
+            self._timer = asyncio.get_event_loop().call_later(max(self.reset_at - time.monotonic(), 0.0),
+                                                              self._on_reset)
+
+    def release(self):
+        self._in_flight -= 1
+        self._wake()
+
+    def release_waiters(self):
+        """Sends everyone waiting back to look up their bucket again"""
+        while self._waiters:
+            fut = self._waiters.popleft()
+            if not fut.done():
+                fut.set_result(False)
+
+    def update(self, headers):
+        """Takes the rate limit headers of a response to a request that is still counted as in flight"""
+        limit = headers.get('X-RateLimit-Limit')
+        if limit is None:
+            self.unlimited = True
+            return
+        self.unlimited = False
+        now = time.monotonic()
+        # the other requests in flight are already subtracted locally but not yet by discord
+        remaining = max(int(headers.get('X-RateLimit-Remaining', 0)) - (self._in_flight - 1), 0)
+        if self.remaining is None or now >= self.reset_at:
+            self.remaining = remaining
+        else:
+            self.remaining = min(self.remaining, remaining)
+        self.limit = int(limit)
+        reset_after = float(headers.get('X-RateLimit-Reset-After', 0))
+        self.window = max(self.window, reset_after)
+        self.reset_at = now + reset_after
+        if self.remaining == 0:
+            logging.debug(f'A rate limit bucket has been exhausted (bucket: {self.key}, '
+                          f'retry: {self.reset_at - now:.2f})')
+
+    def rate_limited(self, retry_after: float):
+        """We got a 429 for this bucket"""
+        self.remaining = 0
+        self.reset_at = time.monotonic() + retry_after
+        if self._timer is not None:
+            # the reset moved, the queue gets rescheduled by the next release
+            self._timer.cancel()
+            self._timer = None
+
+
+class GlobalRateLimiter:
+    """Token bucket for the global rate limit every REST request counts against, waiting requests are served
+    by priority so interaction responses are not stuck behind bulk work.
+
+    Discord allows 50 requests per second unless the bot got a higher limit, raise rate for those.
+    At most burst tokens can be saved up and they refill at rate - burst per `per` seconds, so no window
+    of `per` seconds ever sees more than rate requests."""
+
+    INTERACTION = 0
+    DEFAULT = 1
+
+    def __init__(self, rate: int = 50, per: float = 1.0, burst: int = 5):
+        # the refill has to stay positive
+        if not 0 < burst < rate:
+            raise ValueError(f'burst has to be more than 0 and less than rate ({rate}), got {burst}')
+        self.rate: int = rate
+        self.per: float = per
+        self.burst: int = burst
+        self.tokens: float = float(burst)
+        self._last = time.monotonic()
+        # set after a global 429, nothing gets through till then
+        self._blocked_until: float = 0.0
+        self._waiters: List[Tuple[int, int, asyncio.Future]] = []
+        self._counter = 0
+        self._timer: Optional[asyncio.TimerHandle] = None
+        # wait statistics by priority
+        self.requests: Dict[int, int] = {}
+        self.total_wait: Dict[int, float] = {}
+        self.max_wait: Dict[int, float] = {}
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(float(self.burst), self.tokens + (now - self._last) * (self.rate - self.burst) / self.per)
+        self._last = now
+
+    def _wake(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        self._refill()
+        now = time.monotonic()
+        while self._waiters and now >= self._blocked_until:
+            priority, _, fut = self._waiters[0]
+            if fut.done():
+                heapq.heappop(self._waiters)
+                continue
+            if self.tokens < 1:
+                break
+            heapq.heappop(self._waiters)
+            self.tokens -= 1
+            fut.set_result(None)
+        if self._waiters:
+            delay = max(self._blocked_until - now, (1 - self.tokens) * self.per / (self.rate - self.burst), 0.0)
+            self._timer = asyncio.get_event_loop().call_later(delay, self._wake)
+
+    def _record(self, priority: int, waited: float):
+        self.requests[priority] = self.requests.get(priority, 0) + 1
+        self.total_wait[priority] = self.total_wait.get(priority, 0.0) + waited
+        if waited > self.max_wait.get(priority, 0.0):
+            self.max_wait[priority] = waited
+
+    async def block(self, priority: int = DEFAULT):
+        start = time.monotonic()
+        self._refill()
+        if not self._waiters and self.tokens >= 1 and start >= self._blocked_until:
+            self.tokens -= 1
+            self._record(priority, 0.0)
+            return
+        fut = asyncio.get_event_loop().create_future()
+        heapq.heappush(self._waiters, (priority, self._counter, fut))
+        self._counter += 1
+        self._wake()
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                # granted but not used
+                self.tokens += 1
+            raise
+        self._record(priority, time.monotonic() - start)
+
+    def rate_limited(self, retry_after: float):
+        """We hit the global rate limit anyway, hold back every request till retry_after passed"""
+        self._blocked_until = time.monotonic() + retry_after
+        self.tokens = 0.0
+        if self._waiters:
+            self._wake()
+
+    @property
+    def blocked(self) -> bool:
+        return time.monotonic() < self._blocked_until
+
+
+class BucketStore:
+    """Rate limit buckets by key in least recently used order.
+
+    Holds at most max_size buckets and forgets buckets unused for idle_timeout seconds,
+    buckets that are in use are never dropped (so the store can exceed max_size for a while)."""
+
+    def __init__(self, max_size: int = 10000, idle_timeout: float = 300.0):
+        self.max_size: int = max_size
+        self.idle_timeout: float = idle_timeout
+        self.evicted: int = 0
+        self._buckets: 'OrderedDict[str, RateLimitBucket]' = OrderedDict()
+        self._next_sweep: float = time.monotonic() + idle_timeout
+
+    def get(self, key: str) -> Optional[RateLimitBucket]:
+        bucket = self._buckets.get(key)
+        if bucket is not None:
+            self._buckets.move_to_end(key)
+            bucket.last_used = time.monotonic()
+        return bucket
+
+    def add(self, key: str, bucket: RateLimitBucket):
+        self._buckets[key] = bucket
+        self._buckets.move_to_end(key)
+        bucket.last_used = time.monotonic()
+        self._evict()
+
+    def _evict(self):
+        now = time.monotonic()
+        excess = len(self._buckets) - self.max_size
+        if excess <= 0 and now < self._next_sweep:
+            return
+        self._next_sweep = now + self.idle_timeout / 10
+        victims = []
+        # oldest first, stop at the first bucket that is neither needed to get below max_size nor idle
+        for key, bucket in self._buckets.items():
+            if len(victims) >= excess and now - bucket.last_used < self.idle_timeout:
+                break
+            if not bucket.in_use(now):
+                victims.append(key)
+        for key in victims:
+            del self._buckets[key]
+        self.evicted += len(victims)
+
+    @property
+    def memory(self) -> int:
+        """rough number of bytes used by the stored buckets and their keys"""
+        return sys.getsizeof(self._buckets) + sum(sys.getsizeof(k) + sys.getsizeof(b)
+                                                  for k, b in self._buckets.items())
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._buckets
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+class RESTRateLimiter:
+    """Maps routes to their rate limit buckets.
+
+    Discord reports the bucket of a route in the X-RateLimit-Bucket header, routes sharing a bucket hash
+    share their limit per major parameter (channel, guild, webhook). Till the hash of a route is known,
+    it gets a bucket of its own."""
+
+    def __init__(self, max_buckets: int = 10000, idle_timeout: float = 300.0, max_routes: int = 10000):
+        # bucket hash by "METHOD path", least recently used first
+        self._hashes: 'OrderedDict[str, str]' = OrderedDict()
+        self.max_routes: int = max_routes
+        self.buckets: BucketStore = BucketStore(max_buckets, idle_timeout)
+
+    def _key(self, route: Route) -> str:
+        bucket_hash = self._hashes.get(route.key)
+        if bucket_hash is None:
+            return route.bucket
+        self._hashes.move_to_end(route.key)
+        return f'{bucket_hash}:{route.major_parameters}'
+
+    async def acquire(self, route: Route) -> RateLimitBucket:
+        """Waits till the bucket of the route allows another request, returns the bucket to release afterwards"""
+        while True:
+            # looked up again if the route moved to the bucket of its hash while we waited
+            bucket = self.get_bucket(route)
+            if await bucket.acquire():
+                return bucket
+
+    def get_bucket(self, route: Route) -> RateLimitBucket:
+        key = self._key(route)
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = RateLimitBucket(key)
+            self.buckets.add(key, bucket)
+        return bucket
+
+    def update(self, route: Route, bucket: RateLimitBucket, headers):
+        """Updates the bucket a request was sent with, learning the bucket hash of the route if needed"""
+        bucket.update(headers)
+        bucket_hash = headers.get('X-RateLimit-Bucket')
+        if bucket_hash is not None and self._hashes.get(route.key) != bucket_hash:
+            self._hashes[route.key] = bucket_hash
+            if len(self._hashes) > self.max_routes:
+                # forgetting a hash only means learning it again
+                self._hashes.popitem(last=False)
+            key = self._key(route)
+            if key not in self.buckets:
+                # first route seen with this hash, the state learned so far carries over
+                self.buckets.add(key, bucket)
+                bucket.key = key
+            else:
+                # requests waiting for the old bucket have to move over to the shared one
+                bucket.release_waiters()
+
+    def __len__(self):
+        return len(self.buckets)
@@ -0,0 +1,173 @@
+import asyncio
+import logging
+import os
+import struct
+import time
+import typing
+from typing import Optional, Union, Iterator, Tuple, Dict, List
+
+from . import utils
+from .compression import get_decompressor
+from .errors import ReconnectWebSocket
+from .gateway import DiscordWebSocket, GatewayRateLimiter
+
+if typing.TYPE_CHECKING:
+    from .client import Client
+
+# timestamp, shard id, record kind, payload length
+RECORD_HEADER = struct.Struct('>dHBI')
+RECORD_CONNECT = 0
+RECORD_TEXT = 1
+RECORD_BINARY = 2
+
+
+class GatewayRecorder:
+    """Appends the raw (still compressed) frames received by the gateway to a rotating capture file.
+
+    Set it as client.gateway_recorder, the capture can be fed into a client again with GatewayReplay.
+
+    Frames can only be decompressed from the start of their connection, so files are rotated once they are over
+    max_bytes and a shard connects, and a file grows past max_bytes till then. With multiple shards a rotated
+    file only holds the complete streams of shards that connected after the rotation, the frames of the others
+    are skipped unless the files before it are replayed as well."""
+
+    def __init__(self, path: str, max_bytes: int = 100 * 1024 * 1024, backup_count: int = 5):
+        self.path: str = path
+        self.max_bytes: int = max_bytes
+        self.backup_count: int = backup_count
+        self.frames: int = 0
+        self._file = open(path, 'ab')
+
+    def _write(self, shard_id: int, kind: int, data: bytes):
+        if self._file is None:
+            return
+        self._file.write(RECORD_HEADER.pack(time.time(), shard_id, kind, len(data)))
+        self._file.write(data)
+
+    def _rotate(self):
+        self._file.close()
+        if self.backup_count > 0:
+            for i in range(self.backup_count - 1, 0, -1):
+                src = f'{self.path}.{i}'
+                if os.path.exists(src):
+                    os.replace(src, f'{self.path}.{i + 1}')
+            os.replace(self.path, f'{self.path}.1')
+        self._file = open(self.path, 'wb')
+
+    def record_connect(self, ws: DiscordWebSocket):
+        """Marks the start of a new connection, replays need to know how to decode the following frames"""
+        if self.max_bytes > 0 and self._file is not None and self._file.tell() >= self.max_bytes:
+            # the only point where the new file can start with a complete stream
+            self._rotate()
+        meta = {
+            'encoding': ws.encoding,
+            'compress': ws.decompressor.name if ws.decompressor is not None else None,
+            'shard_count': ws.shard_count
+        }
+        self._write(ws.shard_id, RECORD_CONNECT, utils.get_json_bytes_from_dict(meta))
+        # a replay has to be able to start with a complete connection
+        self._file.flush()
+
+    def record(self, shard_id: int, data: Union[str, bytes]):
+        self.frames += 1
+        if isinstance(data, str):
+            self._write(shard_id, RECORD_TEXT, data.encode('utf-8'))
+        else:
+            self._write(shard_id, RECORD_BINARY, data)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def read_records(path: str) -> Iterator[Tuple[float, int, int, bytes]]:
+    """Yields (timestamp, shard id, kind, payload) for every record of a capture file"""
+    with open(path, 'rb') as f:
+        while True:
+            header = f.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                return
+            ts, shard_id, kind, length = RECORD_HEADER.unpack(header)
+            data = f.read(length)
+            if len(data) < length:
+                # capture was cut off mid record
+                return
+            yield ts, shard_id, kind, data
+
+
+class ReplayWebSocket(DiscordWebSocket):
+    """Web socket without a connection, everything it would send is dropped"""
+
+    def __init__(self, client: 'Client', shard_id: int = 0, shard_count: int = 1):
+        super(ReplayWebSocket, self).__init__(client, shard_id, shard_count)
+        self.sent: int = 0
+
+    async def send_as_json(self, payload: dict, priority: int = GatewayRateLimiter.DEFAULT):
+        self.sent += 1
+
+
+class GatewayReplay:
+    """Feeds a capture of a GatewayRecorder into a client without any network.
+
+    speed is a multiple of the recorded speed, None replays as fast as possible."""
+
+    def __init__(self, client: 'Client', path: Union[str, List[str]], speed: Optional[float] = 1.0):
+        self.client: 'Client' = client
+        self.paths: List[str] = [path] if isinstance(path, str) else path
+        self.speed: Optional[float] = speed
+        self.shards: Dict[int, ReplayWebSocket] = {}
+        self.frames: int = 0
+        self.bytes: int = 0
+        self.elapsed: float = 0.0
+
+    def _connect(self, shard_id: int, meta: dict) -> ReplayWebSocket:
+        ws = self.shards.get(shard_id)
+        if ws is None:
+            ws = ReplayWebSocket(self.client, shard_id, meta.get('shard_count', 1))
+            self.shards[shard_id] = ws
+            # so lookups like Client._get_websocket find the replayed shards
+            if getattr(self.client, 'shards', None) is not None:
+                self.client.shards[shard_id] = ws
+                self.client.shard_count = ws.shard_count
+            if self.client.ws is None:
+                self.client.ws = ws
+        ws.encoding = meta.get('encoding', 'json')
+        ws.decompressor = get_decompressor(meta.get('compress'))
+        return ws
+
+    async def run(self):
+        start = time.perf_counter()
+        first_ts = None
+        try:
+            for path in self.paths:
+                for ts, shard_id, kind, data in read_records(path):
+                    if first_ts is None:
+                        first_ts = ts
+                    if self.speed is not None:
+                        delay = (ts - first_ts) / self.speed - (time.perf_counter() - start)
+                        if delay > 0:
+                            await asyncio.sleep(delay)
+                    if kind == RECORD_CONNECT:
+                        self._connect(shard_id, utils.get_dict_from_json(data))
+                        continue
+                    ws = self.shards.get(shard_id)
+                    if ws is None:
+                        # capture started mid connection, we can't decompress the stream
+                        continue
+                    self.frames += 1
+                    self.bytes += len(data)
+                    try:
+                        await ws.handle_message(data.decode('utf-8') if kind == RECORD_TEXT else data)
+                    except ReconnectWebSocket:
+                        pass
+        finally:
+            for ws in self.shards.values():
+                await ws.close()
+                await ws.dispatcher.drain()
+                # chunk requests of replayed guilds never get an answer, don't leave the tasks behind
+                ws.chunk_scheduler.stop()
+                ws.member_lookup.stop()
+        self.elapsed = time.perf_counter() - start
+        logging.info(f'replayed {self.frames} frames ({self.bytes} bytes) in {self.elapsed:.2f}s '
+                     f'({self.frames / self.elapsed if self.elapsed else 0:.0f} frames/s)')
@@ -1,25 +1,101 @@
+import re
+from functools import lru_cache
+from typing import Tuple
+
 from .utils import *
 
+_PARAMETER = re.compile(r'\{(\w+)\}')
+
+
+def _parameter_str(v) -> str:
+    return str(v.id) if isinstance(v, Snowflake) else str(v)
+
+
+def _parameter_id(v):
+    return v.id if isinstance(v, Snowflake) else v
+
+
+class RouteTemplate:
+    """A route path parsed once, Routes are built from it by passing the parameters in the order
+    they appear in the path:
+
+        MESSAGES = RouteTemplate('POST', '/channels/{channel_id}/messages')
+        route = MESSAGES(channel_id)"""
+
+    __slots__ = ['method', 'path', 'key', 'names', 'interaction', '_url', '_major', '_other_major',
+                 '_channel', '_guild']
+
+    def __init__(self, method: str, path: str):
+        self.method: str = method
+        self.path: str = path
+        # identifies the route regardless of its parameters
+        self.key: str = f'{method} {path}'
+        pieces = _PARAMETER.split(path)
+        self.names: Tuple[str, ...] = tuple(pieces[1::2])
+        # positional format strings, literal braces of the path escaped
+        self._url: str = ''.join(p.replace('{', '{{').replace('}', '}}') if i % 2 == 0 else f'{{{i // 2}}}'
+                                 for i, p in enumerate(pieces))
+        self._major: str = ':'.join(f'{{{self.names.index(k)}}}' if k in self.names else ''
+                                    for k in Route.MAJOR_PARAMETERS)
+        # major parameters that can only be passed as keywords
+        self._other_major: Tuple[str, ...] = tuple(k for k in Route.MAJOR_PARAMETERS if k not in self.names)
+        self._channel: int = self.names.index('channel_id') if 'channel_id' in self.names else -1
+        self._guild: int = self.names.index('guild_id') if 'guild_id' in self.names else -1
+        # interaction responses are served first by the global rate limiter
+        self.interaction: bool = 'interaction_token' in self.names
+
+    def __call__(self, *values) -> 'Route':
+        if len(values) != len(self.names):
+            raise TypeError(f'{self.key} takes {len(self.names)} parameters, got {len(values)}')
+        return Route.from_template(self, values)
+
+
+@lru_cache(maxsize=1024)
+def compile_route(method: str, path: str) -> RouteTemplate:
+    """Returns the template of a path, paths built with f-strings are only cached up to maxsize"""
+    return RouteTemplate(method, path)
+
 
 class Route:
     BASE_URL = f'https://discord.com/api/v{API_VERSION}'
+    # parameters discord keeps separate rate limits for, even within the same bucket
+    MAJOR_PARAMETERS = ('channel_id', 'guild_id', 'webhook_id', 'webhook_token', 'interaction_token')
+
+    __slots__ = ['method', 'path', 'key', 'url', 'channel_id', 'guild_id', 'interaction',
+                 'major_parameters', 'bucket']
 
     def __init__(self, method: str, path: str, **parameters):
-        self.path = path
-        self.method = method
-        self.url = self.BASE_URL + self.path
-
-        if parameters:
-            for k, v in parameters.items():
-                self.url = self.url.replace('{'+k+'}', str(v.id) if isinstance(v, Snowflake) else str(v))
-
-        self.channel_id = parameters.get('channel_id')
-        if isinstance(self.channel_id, Snowflake):
-            self.channel_id = self.channel_id.id
-        self.guild_id = parameters.get('guild_id')
-        if isinstance(self.guild_id, Snowflake):
-            self.guild_id = self.guild_id.id
-
-    @property
-    def bucket(self):
-        return f'{self.channel_id}:{self.guild_id}:{self.path}'
+        template = compile_route(method, path)
+        # parameters missing from the call stay in the url as they are
+        values = [parameters.get(k, '{' + k + '}') for k in template.names]
+        self._build(template, values)
+        for k in template._other_major:
+            if k in parameters:
+                # major parameters not in the path (e.g. guild_id of an f-string path) still count
+                self.major_parameters = ':'.join(_parameter_str(parameters[k]) if k in parameters else ''
+                                                 for k in self.MAJOR_PARAMETERS)
+                self.bucket = f'{self.major_parameters}:{self.key}'
+                self.channel_id = _parameter_id(parameters.get('channel_id'))
+                self.guild_id = _parameter_id(parameters.get('guild_id'))
+                self.interaction = self.interaction or 'interaction_token' in parameters
+                break
+
+    @classmethod
+    def from_template(cls, template: RouteTemplate, values) -> 'Route':
+        route = cls.__new__(cls)
+        route._build(template, values)
+        return route
+
+    def _build(self, template: RouteTemplate, values):
+        self.method: str = template.method
+        self.path: str = template.path
+        # identifies the route regardless of its parameters
+        self.key: str = template.key
+        strs = [str(v.id) if isinstance(v, Snowflake) else str(v) for v in values]
+        self.url: str = self.BASE_URL + template._url.format(*strs)
+        self.interaction: bool = template.interaction
+        self.channel_id = _parameter_id(values[template._channel]) if template._channel >= 0 else None
+        self.guild_id = _parameter_id(values[template._guild]) if template._guild >= 0 else None
+        self.major_parameters: str = template._major.format(*strs)
+        # rate limit bucket used till discord told us the bucket hash of this route
+        self.bucket: str = f'{self.major_parameters}:{template.key}'
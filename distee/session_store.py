@@ -0,0 +1,47 @@
+import logging
+import os
+from abc import ABC, abstractmethod
+from typing import Dict
+
+from . import utils
+
+
+class BaseSessionStore(ABC):
+    """Keeps the gateway session state of all shards so they can be resumed after a restart"""
+
+    @abstractmethod
+    def load(self) -> Dict[int, dict]:
+        """Returns the stored session state by shard id"""
+        pass
+
+    @abstractmethod
+    def save(self, sessions: Dict[int, dict]):
+        """Stores the session state of the given shards, see DiscordWebSocket.get_session"""
+        pass
+
+
+class FileSessionStore(BaseSessionStore):
+    """Strategy: keep the session state of all shards in a json file"""
+
+    def __init__(self, path: str):
+        self.path: str = path
+
+    def load(self) -> Dict[int, dict]:
+        try:
+            with open(self.path, 'rb') as f:
+                data = utils.get_dict_from_json(f.read())
+        except FileNotFoundError:
+            return {}
+        except ValueError:
+            logging.warning(f'could not read session state from {self.path}, ignoring it')
+            return {}
+        return {int(k): v for k, v in data.items()}
+
+    def save(self, sessions: Dict[int, dict]):
+        # keep the state of shards that are run by someone else
+        data = self.load()
+        data.update(sessions)
+        tmp = f'{self.path}.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(utils.get_json_bytes_from_dict({str(k): v for k, v in data.items()}))
+        os.replace(tmp, self.path)
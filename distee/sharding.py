@@ -0,0 +1,78 @@
+import asyncio
+import logging
+from typing import Optional, List, Dict
+
+from .client import Client
+from .flags import Intents
+from .gateway import DiscordWebSocket
+from .supervisor import ShardSupervisor
+
+
+class AutoShardedClient(Client):
+    """Client that runs multiple shards in this process, all sharing the same loop and HTTPClient.
+
+    If no shard_count is given, the shard count recommended by Discord is used.
+    Use shard_ids to only run a part of all shards in this process."""
+
+    def __init__(self, shard_count: Optional[int] = None, shard_ids: Optional[List[int]] = None):
+        super().__init__()
+        self.shard_count: Optional[int] = shard_count
+        self.shard_ids: Optional[List[int]] = shard_ids
+        self.shards: Dict[int, DiscordWebSocket] = {}
+
+    def _get_websocket(self, guild_id: Optional[int] = None) -> Optional[DiscordWebSocket]:
+        if guild_id is None:
+            return self.ws
+        # None for guilds on shards of other processes
+        return self.shards.get((guild_id >> 22) % self.shard_count)
+
+    @property
+    def latencies(self) -> Dict[int, float]:
+        """latency of the latest heartbeat in seconds by shard id"""
+        return {sid: ws.latency for sid, ws in self.shards.items()}
+
+    def get_shard_id(self, guild_id: int) -> int:
+        """Returns the id of the shard the given guild is on"""
+        return (guild_id >> 22) % self.shard_count
+
+    async def update_activity(self, activity: Optional[dict]):
+        self.activity = activity
+        await asyncio.gather(*[ws.update_presence() for ws in self.shards.values()])
+
+    def _all_websockets(self) -> List[DiscordWebSocket]:
+        return list(self.shards.values())
+
+    async def connect(self):
+        """establish a web socket connection per shard and keep them running"""
+        self._load_sessions()
+        data = await self.http.get_bot_gateway()
+        if self.shard_count is None:
+            self.shard_count = data['shards']
+        if self.shard_ids is None:
+            self.shard_ids = list(range(self.shard_count))
+        self.identify_limiter.update(data.get('session_start_limit', {}))
+        logging.info(f'launching {len(self.shard_ids)} of {self.shard_count} shards')
+        self.shards = {sid: DiscordWebSocket(self, sid, self.shard_count) for sid in self.shard_ids}
+        self.ws = self.shards[self.shard_ids[0]]
+        resume = {sid: ws.restore_session(self.resume_sessions.get(sid)) for sid, ws in self.shards.items()}
+        if self.rehydrate_guilds and any(resume.values()):
+            asyncio.ensure_future(self._rehydrate_guilds([self.shards[sid] for sid, r in resume.items() if r]))
+        await asyncio.gather(*[self._run_websocket(ws, resume[sid]) for sid, ws in self.shards.items()])
+
+    def run_multiprocess(self, token: str, intents: Intents = Intents.default(), processes: Optional[int] = None):
+        """Runs the shards of this client spread over multiple worker processes, see ShardSupervisor"""
+        ShardSupervisor(self, processes).run(token, intents)
+
+    async def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._save_sessions()
+        await self.http.close()
+        if self.gateway_recorder is not None:
+            self.gateway_recorder.close()
+        await asyncio.gather(*[ws.close() for ws in self.shards.values()], return_exceptions=True)
+        for ws in self.shards.values():
+            ws.chunk_scheduler.stop()
+            ws.member_lookup.stop()
+        await asyncio.gather(*[ws.dispatcher.stop() for ws in self.shards.values()], return_exceptions=True)
@@ -0,0 +1,295 @@
+import asyncio
+import heapq
+import logging
+import multiprocessing
+import os
+import signal
+import time
+import typing
+from collections import deque
+from multiprocessing.connection import wait, Connection
+from typing import Optional, List, Dict, Tuple, Deque
+
+from .errors import ClientException, ConnectionClosed, PriviledgedIntentsRequired
+from .flags import Intents
+from .gateway import IdentifyLimiter, SessionStartLimit
+from .http import HTTPClient
+
+if typing.TYPE_CHECKING:
+    from .sharding import AutoShardedClient
+
+
+class WorkerIdentifyLimiter(IdentifyLimiter):
+    """Identify limiter of a worker process, every identify has to be granted by the supervisor"""
+
+    def __init__(self, conn: Connection):
+        super(WorkerIdentifyLimiter, self).__init__()
+        self._conn: Connection = conn
+        self._waiters: Dict[int, asyncio.Future] = {}
+        self._reading: bool = False
+
+    def _read_grants(self):
+        while self._conn.poll():
+            shard_id, remaining = self._conn.recv()
+            if self.session_start_limit is not None:
+                # the supervisor keeps the real budget, mirror it for Client.remaining_session_starts
+                self.session_start_limit.remaining = remaining
+            fut = self._waiters.pop(shard_id, None)
+            if fut is not None and not fut.done():
+                fut.set_result(None)
+            else:
+                # nobody waits for it anymore, hand the slot back right away
+                self._conn.send(('identified', shard_id))
+
+    async def block(self, shard_id: int):
+        loop = asyncio.get_event_loop()
+        if not self._reading:
+            # grants are read on the loop itself, no thread needed
+            loop.add_reader(self._conn.fileno(), self._read_grants)
+            self._reading = True
+        fut = loop.create_future()
+        self._waiters[shard_id] = fut
+        self._conn.send(('identify', shard_id))
+        try:
+            await fut
+        finally:
+            self._waiters.pop(shard_id, None)
+
+    def release(self, shard_id: int):
+        # the supervisor starts the 5 seconds of the slot from here
+        self._conn.send(('identified', shard_id))
+
+
+class ShardSupervisor:
+    """Spreads the shards of a AutoShardedClient over multiple forked worker processes.
+
+    Every worker runs a contiguous range of shards. Identifies of all workers are coordinated by this process
+    so max_concurrency is respected and workers that crashed get restarted and resume their sessions.
+
+    The supervisor itself runs no threads, so forking a replacement worker at any time is safe."""
+
+    FATAL_EXIT_CODE = 3
+
+    def __init__(self, client: 'AutoShardedClient', processes: Optional[int] = None):
+        self.client: 'AutoShardedClient' = client
+        self.processes: int = processes if processes is not None else os.cpu_count()
+        self.session_report_interval: float = 5.0
+        self.restart_delay: float = 5.0
+        self.shard_count: Optional[int] = None
+        self.max_concurrency: int = 1
+        self.session_start_limit: Optional[SessionStartLimit] = None
+        self._ctx = multiprocessing.get_context('fork')
+        # supervisor end of the pipe to every worker
+        self._conns: List[Optional[Connection]] = []
+        self._ranges: List[List[int]] = []
+        self._workers: List[Optional[multiprocessing.Process]] = []
+        self._sessions: Dict[int, dict] = {}
+        self._next_identify: Dict[int, float] = {}
+        # identify requests waiting for their rate_limit_key and the shard holding each key, as (worker, shard_id)
+        self._identify_queue: Dict[int, Deque[Tuple[int, int]]] = {}
+        self._identifying: Dict[int, Tuple[int, int]] = {}
+        # (at, counter, worker, message), grants and restarts waiting for their time
+        self._timers: List[Tuple[float, int, int, Optional[tuple]]] = []
+        self._counter = 0
+        self._stopping = False
+
+    async def _fetch_gateway(self, token: str) -> dict:
+        http = HTTPClient(self.client, asyncio.get_event_loop())
+        try:
+            if await http.do_login(token) is None:
+                raise ClientException('Failed to log in')
+            return await http.get_bot_gateway()
+        finally:
+            await http.close()
+
+    def _schedule(self, at: float, worker: int, msg: Optional[tuple]):
+        """sends msg to the worker at the given time, None restarts the worker instead"""
+        heapq.heappush(self._timers, (at, self._counter, worker, msg))
+        self._counter += 1
+
+    def _grant_next(self, key: int):
+        """Grants the next identify of a rate_limit_key, one shard at a time"""
+        queue = self._identify_queue.get(key)
+        if key in self._identifying or not queue:
+            return
+        worker, shard_id = queue.popleft()
+        now = time.monotonic()
+        at = max(now, self._next_identify.get(key, 0.0))
+        # the budget is shared by all workers, so it is tracked here and not in the workers
+        delay = self.session_start_limit.consume()
+        if delay > 0:
+            logging.error(f'session start limit used up, shard {shard_id} waits {delay:.0f}s for the reset')
+            at = max(at, now + delay)
+        self._identifying[key] = (worker, shard_id)
+        self._schedule(at, worker, (shard_id, self.session_start_limit.remaining))
+
+    def _release_identify(self, key: int):
+        # the next shard of the key may identify 5 seconds after this one did
+        del self._identifying[key]
+        self._next_identify[key] = time.monotonic() + 5.0
+        self._grant_next(key)
+
+    def _handle(self, worker: int, msg: tuple):
+        if msg[0] == 'identify':
+            _, shard_id = msg
+            key = shard_id % self.max_concurrency
+            self._identify_queue.setdefault(key, deque()).append((worker, shard_id))
+            self._grant_next(key)
+        elif msg[0] == 'identified':
+            _, shard_id = msg
+            key = shard_id % self.max_concurrency
+            if self._identifying.get(key) == (worker, shard_id):
+                self._release_identify(key)
+        elif msg[0] == 'session':
+            _, shard_id, state = msg
+            self._sessions[shard_id] = state
+
+    @staticmethod
+    def _report_sessions(client: 'AutoShardedClient', conn: Connection):
+        for sid, ws in client.shards.items():
+            conn.send(('session', sid, ws.get_session()))
+
+    async def _session_reporter(self, client: 'AutoShardedClient', conn: Connection):
+        while not client.is_closed():
+            await asyncio.sleep(self.session_report_interval)
+            self._report_sessions(client, conn)
+
+    def _worker_main(self, worker: int, conn: Connection, token: str, intents: Intents):
+        # the supervisor signal handlers got inherited, the client installs its own
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        client = self.client
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        client.loop = loop
+        # keeps everything configured on the http client, it has no session before login
+        client.http.loop = loop
+        client.shard_count = self.shard_count
+        client.shard_ids = self._ranges[worker]
+        client.identify_limiter = WorkerIdentifyLimiter(conn)
+        client.resume_sessions = {sid: self._sessions[sid] for sid in client.shard_ids if sid in self._sessions}
+        user_shutdown_handler = client.shutdown_handler
+
+        def shutdown_handler():
+            self._report_sessions(client, conn)
+            if user_shutdown_handler is not None:
+                user_shutdown_handler()
+
+        client.shutdown_handler = shutdown_handler
+        loop.create_task(self._session_reporter(client, conn))
+        logging.info(f'worker {worker} (pid {os.getpid()}) starting shards {client.shard_ids[0]}-{client.shard_ids[-1]}')
+        try:
+            client.run(token, intents)
+        except (ConnectionClosed, PriviledgedIntentsRequired):
+            logging.exception(f'worker {worker} can not continue')
+            raise SystemExit(self.FATAL_EXIT_CODE)
+
+    def _spawn(self, worker: int, token: str, intents: Intents):
+        # fresh pipe so grants still pending for a crashed worker can not reach its replacement
+        if self._conns[worker] is not None:
+            self._conns[worker].close()
+        conn, child_conn = self._ctx.Pipe()
+        p = self._ctx.Process(target=self._worker_main, args=(worker, child_conn, token, intents),
+                              name=f'distee-worker-{worker}')
+        p.start()
+        child_conn.close()
+        self._conns[worker] = conn
+        self._workers[worker] = p
+
+    def _stop(self, *args):
+        self._stopping = True
+        for p in self._workers:
+            if p is not None and p.is_alive():
+                p.terminate()
+
+    def run(self, token: str, intents: Intents = Intents.default()):
+        data = asyncio.run(self._fetch_gateway(token))
+        self.shard_count = self.client.shard_count if self.client.shard_count is not None else data['shards']
+        self.session_start_limit = SessionStartLimit(data.get('session_start_limit', {}))
+        self.max_concurrency = self.session_start_limit.max_concurrency
+        shard_ids = self.client.shard_ids if self.client.shard_ids is not None else list(range(self.shard_count))
+        processes = max(1, min(self.processes, len(shard_ids)))
+        per, extra = divmod(len(shard_ids), processes)
+        start = 0
+        for i in range(processes):
+            end = start + per + (1 if i < extra else 0)
+            self._ranges.append(shard_ids[start:end])
+            start = end
+        self._conns = [None] * processes
+        self._workers = [None] * processes
+        logging.info(f'supervising {len(shard_ids)} of {self.shard_count} shards in {processes} processes '
+                     f'({self.session_start_limit.remaining} of {self.session_start_limit.total} session starts remaining)')
+
+        signal.signal(signal.SIGINT, self._stop)
+        signal.signal(signal.SIGTERM, self._stop)
+        for i in range(processes):
+            self._spawn(i, token, intents)
+        try:
+            self._serve(token, intents)
+        finally:
+            self._stop()
+
+    def _serve(self, token: str, intents: Intents):
+        """handles the messages, grants and restarts of all workers till every worker is gone"""
+        while any(p is not None for p in self._workers) or self._timers:
+            timeout = max(self._timers[0][0] - time.monotonic(), 0.0) if self._timers else None
+            sources = {}
+            for i, p in enumerate(self._workers):
+                if p is not None:
+                    sources[p.sentinel] = i
+                if self._conns[i] is not None:
+                    sources[self._conns[i]] = i
+            for obj in wait(list(sources.keys()), timeout):
+                if isinstance(obj, Connection):
+                    self._receive(sources[obj])
+            now = time.monotonic()
+            while self._timers and self._timers[0][0] <= now:
+                _, _, worker, msg = heapq.heappop(self._timers)
+                if msg is None:
+                    if not self._stopping:
+                        self._spawn(worker, token, intents)
+                elif self._workers[worker] is not None and self._conns[worker] is not None:
+                    try:
+                        self._conns[worker].send(msg)
+                    except OSError:
+                        pass
+            for i, p in enumerate(self._workers):
+                if p is None or p.is_alive():
+                    continue
+                self._workers[i] = None
+                # whatever the worker still sent is handled, the session states are needed for the restart
+                self._receive(i)
+                if self._stopping or p.exitcode == 0:
+                    logging.info(f'worker {i} exited')
+                    continue
+                if p.exitcode == self.FATAL_EXIT_CODE:
+                    logging.error(f'worker {i} hit a unrecoverable error, shutting down')
+                    self._stop()
+                    continue
+                logging.warning(f'worker {i} crashed with exit code {p.exitcode}, '
+                                f'restarting in {self.restart_delay:.2f}s')
+                # pending grants of the crashed worker are dropped, its replacement asks again
+                self._timers = [t for t in self._timers if t[2] != i]
+                heapq.heapify(self._timers)
+                self._drop_identifies(i)
+                self._schedule(time.monotonic() + self.restart_delay, i, None)
+            if self._stopping:
+                # nobody is left to grant anything to or to restart
+                self._timers.clear()
+
+    def _drop_identifies(self, worker: int):
+        for key, queue in self._identify_queue.items():
+            self._identify_queue[key] = deque(r for r in queue if r[0] != worker)
+        for key in [k for k, (w, _) in self._identifying.items() if w == worker]:
+            # it may have identified right before it died, so the slot is held for the full window
+            self._release_identify(key)
+
+    def _receive(self, worker: int):
+        conn = self._conns[worker]
+        try:
+            while conn is not None and conn.poll():
+                self._handle(worker, conn.recv())
+        except (EOFError, OSError):
+            # the worker is gone, its process sentinel tells us what happened
+            conn.close()
+            self._conns[worker] = None
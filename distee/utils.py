@@ -1,6 +1,7 @@
 import datetime
 import json
-from typing import TYPE_CHECKING, Union
+import logging
+from typing import TYPE_CHECKING, Union, Callable, Any, Dict
 
 
 if TYPE_CHECKING:
@@ -11,12 +12,59 @@ GATEWAY_VERSION = 10
 API_VERSION = 10
 
 
-def get_dict_from_json(data) -> dict:
-    return json.loads(data)
+class JSONCodec:
+    """A json implementation. loads has to accept both str and bytes, dumps has to return bytes"""
+
+    def __init__(self, name: str, loads: Callable[[Union[str, bytes]], Any], dumps: Callable[[Any], bytes]):
+        self.name: str = name
+        self.loads = loads
+        self.dumps = dumps
+
+
+_json_codecs: Dict[str, JSONCodec] = {}
+_json_codec: JSONCodec = None
+
+
+def register_json_codec(codec: JSONCodec):
+    _json_codecs[codec.name] = codec
+
+
+def set_json_codec(name: str):
+    """Selects the json implementation used for all gateway and http payloads"""
+    global _json_codec
+    _json_codec = _json_codecs[name]
+    logging.debug(f'using json codec {name}')
+
+
+def get_json_codec() -> JSONCodec:
+    return _json_codec
+
+
+register_json_codec(JSONCodec('json', json.loads, lambda d: json.dumps(d).encode('utf-8')))
+try:
+    import ujson
+    register_json_codec(JSONCodec('ujson', ujson.loads, lambda d: ujson.dumps(d).encode('utf-8')))
+except ImportError:
+    pass
+try:
+    import orjson
+    register_json_codec(JSONCodec('orjson', orjson.loads, lambda d: orjson.dumps(d, option=orjson.OPT_NON_STR_KEYS)))
+except ImportError:
+    pass
+# pick the fastest one available
+set_json_codec('orjson' if 'orjson' in _json_codecs else 'ujson' if 'ujson' in _json_codecs else 'json')
+
+
+def get_dict_from_json(data: Union[str, bytes]) -> dict:
+    return _json_codec.loads(data)
 
 
 def get_json_from_dict(data) -> str:
-    return json.dumps(data)
+    return _json_codec.dumps(data).decode('utf-8')
+
+
+def get_json_bytes_from_dict(data) -> bytes:
+    return _json_codec.dumps(data)
 
 
 def command_lists_equal(local, remote) -> bool:
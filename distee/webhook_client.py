@@ -4,9 +4,9 @@ import logging
 from aiohttp import web
 from nacl.signing import VerifyKey
 from nacl.exceptions import BadSignatureError
-import json
 
 from distee.base_client import BaseClient
+from distee.utils import get_dict_from_json
 
 
 class WebhookClient(BaseClient):
@@ -25,7 +25,7 @@ class WebhookClient(BaseClient):
         except BadSignatureError:
             return web.Response(body='invalid request signature', status=401)
         # handle PING
-        data = json.loads(body)
+        data = get_dict_from_json(body)
         if data['type'] == 1:
             return web.json_response({'type': 1})
         else:
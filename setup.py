@@ -34,5 +34,8 @@ setup(name='distee.py',
       version=version,
       description='A Discord API wrapper',
       install_requires=requirements,
+      extras_require={
+          'speed': ['orjson', 'zstandard']
+      },
       python_requires='>=3.9.0',
       packages=find_packages())